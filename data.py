@@ -5,11 +5,32 @@ Data format (sample):
 {"text": "TITLE: There is a difference between a'smurf' and an'alt'. Please learn it and stop using them interchangeably. POST: Someone once told me they have an\"alt\" cause their main account was too high of rank to play with their friends. It's exactly the same as smurfing.\n", "labels": [[118, 265, "false analogy"]], "comments": ["False Analogy: X: Having an alt , Y: smurfing, P: Both involve having a secondary account.", "We removed the hasty gen", "the text may involve a \"False Equivalence\" fallacy. This is when someone incorrectly asserts that two or more things are equivalent, simply because they share some characteristics, despite the fact that there are also notable differences between them. In your example, the person is equating having an 'alt' account to play with friends of a lower rank with 'smurfing'. While both involve using a secondary account, the motivations and consequences may be different, so it's not necessarily accurate or fair to say they are \"exactly the same\".\n\nThis could be seen as a folse analogy too."], "sentences_with_labels": "{\"TITLE: There is a difference between a'smurf' and an'alt'.\": [[\"nothing\"]], \"Please learn it and stop using them interchangeably.\": [[\"nothing\"]], \"POST:\": [[\"nothing\"]], \"Someone once told me they have an\\\"alt\\\" cause their main account was too high of rank to play with their friends.\": [[\"false analogy\"]], \"It's exactly the same as smurfing.\": [[\"false analogy\"]]}"}
 """
 
+import gzip
+import hashlib
+import io
 import json
-from torch.utils.data import Dataset
+import os
+import threading
+import numpy as np
 from random import shuffle
 import re
 
+def text_hash(text: str) -> str:
+    """ Stable hash of a document text, used to match documents across files."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def find_data_file(path: str) -> str:
+    """ The path of a data file, or of its gzip compressed copy if only that exists."""
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+def open_data_file(path: str):
+    """ Open a data file for reading bytes, decompressing it if it is gzip compressed."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
 """
 This class should preprocess the data by splitting it into:
 - prompt
@@ -22,6 +43,8 @@ class Label:
     """
     Simple class to represent a label in the dataset.
     """
+    __slots__ = ("start", "end", "name")
+
     def __init__(self, start: int, end: int, name: str):
         self.start = start
         self.end = end
@@ -42,46 +65,180 @@ class Label:
             return set()
         return set(range(self.start, self.end + 1))
 
-class Data(Dataset):
+    def length(self) -> int:
+        """ Return the number of indices, without building them (the same as len(self.indices()))."""
+        if self.start == -1 and self.end == -1:
+            return 0
+        return max(0, self.end - self.start + 1)
+
+    def overlap(self, other) -> int:
+        """ Return the number of shared indices, without building them (the same as len(self.indices() & other.indices()))."""
+        if self.length() == 0 or other.length() == 0:
+            return 0
+        return max(0, min(self.end, other.end) - max(self.start, other.start) + 1)
+
+class Data:
     """
-    Standard dataset class for the data from the golden standard dataset.
+    Standard dataset class for the data from the golden standard dataset (a map-style dataset, so it can be passed to a
+    torch DataLoader, without importing torch here).
+
+    The data is stored in columns: the texts in a list, and the labels of all texts in parallel integer arrays
+    (start, end and label code), where the labels of text i are at label_offsets[i]:label_offsets[i + 1].
+    The columns are only built once all data is needed (e.g. when iterating), before that single items
+    are read directly from the file through the line offsets, over a single handle that is kept open. Other fields
+    (such as the comments) are only parsed on demand, see get_field. The parsed lines of the original implementation
+    are still available as the data property.
 
     parameters:
-    - (Optional) data_path: str, the path to the data file
+    - (Optional) data_path: str, the path to the data file (the gzip compressed copy is read if only that exists)
     - (Optional) sample_size: int, the size of the sample to take from the data
     """
     def __init__(self, data_path="data/gold_standard_dataset.jsonl", sample_size=None):
-        self.data_path = data_path
-        self.data = self.load_data(data_path, sample_size=sample_size)
+        self.data_path = find_data_file(data_path)
+        # The handle the lines are read from, opened on first use (see get_handle)
+        self.handle = None
+        self.handle_lock = threading.Lock()
+        self.load_data(self.data_path, sample_size=sample_size)
 
     def change_sample_size(self, sample_size: int):
-        self.data = self.load_data(self.data_path, sample_size=sample_size)
+        self.load_data(self.data_path, sample_size=sample_size)
     
     def load_data(self, data_path: str, sample_size: int = None):
-        """ Load the data from the given path. (Possibly adjust for sample size, by randomly shuffling and taking the first n elements.) """
-        with open(data_path, "r") as f:
-                data = [json.loads(line) for line in f]
+        """ Index the lines of the given path. (Possibly adjust for sample size, by randomly shuffling and taking the first n lines.) """
+        line_offsets = []
+        with open_data_file(data_path) as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    line_offsets.append(offset)
+                offset += len(line)
         if sample_size is not None:
-            shuffle(data)
-            data = data[:sample_size]
-        return data
+            shuffle(line_offsets)
+            line_offsets = line_offsets[:sample_size]
+        self.line_offsets = line_offsets
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        self.items = None
+
+        # The columns, built on first use (see load_columns)
+        self.texts = None
+        self.label_offsets = None
+        self.starts = None
+        self.ends = None
+        self.codes = None
+        self.label_names = []
+        # The hash of the texts, computed on first use (see get_hash)
+        self.hash = None
+
+    def load_columns(self):
+        """ Parse all lines once into the text and label columns."""
+        if self.texts is not None:
+            return
+        texts = []
+        label_offsets = [0]
+        starts, ends, codes = [], [], []
+        label_codes = {}
+        for idx in range(len(self)):
+            item = self.read_item(idx)
+            texts.append(item["text"])
+            for start, end, name in item["labels"]:
+                starts.append(start)
+                ends.append(end)
+                codes.append(label_codes.setdefault(name, len(label_codes)))
+            label_offsets.append(len(starts))
+
+        self.texts = texts
+        self.label_offsets = np.array(label_offsets, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.codes = np.array(codes, dtype=np.int32)
+        self.label_names = list(label_codes)
+
+    def get_hash(self) -> str:
+        """ Hash of the texts in the data (in order), to key what is derived from the data (e.g. the demonstrations)."""
+        if self.hash is None:
+            self.load_columns()
+            self.hash = hashlib.sha1("".join(text_hash(text) for text in self.texts).encode("utf-8")).hexdigest()
+        return self.hash
+
+    def get_handle(self):
+        """
+        The handle the lines are read from, which is only opened once. A gzip compressed file is decompressed into memory,
+        as seeking in it would decompress everything before the line again for every read.
+        """
+        if self.handle is None:
+            if self.data_path.endswith(".gz"):
+                with open_data_file(self.data_path) as f:
+                    self.handle = io.BytesIO(f.read())
+            else:
+                self.handle = open_data_file(self.data_path)
+        return self.handle
+
+    def read_item(self, idx: int) -> dict:
+        """ Read and parse a single line of the data file."""
+        # The handle is shared, e.g. with the thread that builds the prompts of a pipelined experiment
+        with self.handle_lock:
+            f = self.get_handle()
+            f.seek(self.line_offsets[idx])
+            line = f.readline()
+        return json.loads(line)
+
+    @property
+    def data(self) -> list:
+        """ All parsed lines (with every field), as the data was stored before it was stored in columns. Parsed once."""
+        if self.items is None:
+            self.items = [self.read_item(idx) for idx in range(len(self))]
+        return self.items
+
+    def __getstate__(self):
+        # The handle and its lock can not be pickled (e.g. to pass the data to other processes), they are opened again there
+        state = dict(self.__dict__)
+        state["handle"] = None
+        state["handle_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handle_lock = threading.Lock()
+
+    def get_field(self, idx: int, field: str):
+        """ Get any field of an item (e.g. the comments), parsed on demand. Doubly encoded fields are decoded as well."""
+        value = self.read_item(idx)[field]
+        if field == "sentences_with_labels":
+            value = json.loads(value)
+        return value
     
     def __len__(self):
-        return len(self.data)
+        return len(self.line_offsets)
     
     def __getitem__(self, idx: int):
-        item = self.data[idx]
-        prompt = item["text"]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Data index out of range")
+
+        # Read the item directly from the file if the columns are not built (yet)
+        if self.texts is None:
+            item = self.read_item(idx)
+            return item["text"], [Label(label[0], label[1], label[2]) for label in item["labels"]]
+
+        prompt = self.texts[idx]
         # process the prompt (adjust for title, post, etc.)
         # TODO: decide whether this is necessary
         # prompt = re.sub(r"TITLE:|POST:|COMMENT:|SENTENCE:|\"|\\", "", prompt)
  
-        labels = item["labels"]
+        first, last = self.label_offsets[idx], self.label_offsets[idx + 1]
         formatted_labels = []
-        for label in labels:
-            formatted_labels.append(Label(label[0], label[1], label[2]))
+        for start, end, code in zip(self.starts[first:last].tolist(), self.ends[first:last].tolist(), self.codes[first:last].tolist()):
+            formatted_labels.append(Label(start, end, self.label_names[code]))
         
         return prompt, formatted_labels
+
+    def __iter__(self):
+        self.load_columns()
+        for idx in range(len(self)):
+            yield self[idx]
     
 
 if __name__ == "__main__":
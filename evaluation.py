@@ -1,11 +1,81 @@
-from data import Data
+from data import Data, find_data_file, text_hash
 from typing import List
 from util import get_all_models, get_all_prompting_techniques
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import pandas as pd
 
+# Bump this whenever the scoring changes, such that cached results are not reused
+SCORING_VERSION = 1
+
+# Gold standards that are already loaded (in this process), per path
+GOLD_STANDARDS = {}
+
+
+def load_gold_standard(gold_path: str) -> tuple:
+    """
+    Load the labels of the gold standard and its index by the hash of the text (to match the responses to it).
+    This is only done once per process.
+    """
+    if gold_path not in GOLD_STANDARDS:
+        gold_labels = []
+        gold_index = {}
+        for i, (text, labels) in enumerate(Data(data_path=gold_path)):
+            gold_labels.append(labels)
+            gold_index.setdefault(text_hash(text), i)
+        GOLD_STANDARDS[gold_path] = (gold_labels, gold_index)
+    return GOLD_STANDARDS[gold_path]
+
+
+def file_hash(path: str) -> str:
+    """ Hash of the content of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def evaluate_files(paths: List[str], gold_path: str) -> List[dict]:
+    """
+    Evaluate a chunk of response files against the gold standard (run in a worker process), the runs of all files are
+    scored together in one pass (see EvaluationFrameWork.score_runs).
+    Returns per file the scores (with and without indices), the confusion matrix and the alignment report, in a JSON
+    serialisable format.
+    """
+    gold_labels, gold_index = load_gold_standard(gold_path)
+
+    # Match the responses to the gold standard
+    runs = {}
+    reports = {}
+    for path in paths:
+        P, G, reports[path] = EvaluationFrameWork.align(Data(data_path=path), gold_labels, gold_index)
+
+        # Fix uppercase error in "Nothing" of the predicted labels
+        for p in P:
+            for label in p:
+                if label.name == "Nothing":
+                    label.name = "nothing"
+        runs[path] = (P, G)
+
+    scores = EvaluationFrameWork.score_runs(runs)
+    results = []
+    for path, (P, G) in runs.items():
+        cm, classes = EvaluationFrameWork.compute_confusion_matrix(P, G)
+        results.append({
+            "scores": {str(include_indices): scores[(path, include_indices)] for include_indices in (True, False)},
+            "matrix": cm.tolist(),
+            "classes": classes,
+            "alignment": reports[path]
+        })
+    return results
+
+
 class EvaluationFrameWork:
     """
     This class is used to evaluate the performance of the models.
@@ -13,9 +83,11 @@ class EvaluationFrameWork:
     parameters:
     - models: List, the models to evaluate
     - prompting_techniques: List, the prompting techniques to evaluate
+    - num_workers: int, the number of processes that evaluate the response files (Optional, default is the number of CPUs)
+    - cache_dir: str, the directory where the results per response file are cached (Optional, default is data/evaluation_cache)
     """
 
-    def __init__(self, models: List = None, prompting_techniques: List = None):
+    def __init__(self, models: List = None, prompting_techniques: List = None, num_workers: int = None, cache_dir: str = "data/evaluation_cache"):
         # Default to all models and prompting techniques if none are given
         if models is None:
             models = get_all_models()
@@ -24,6 +96,8 @@ class EvaluationFrameWork:
 
         self.models = models
         self.prompting_techniques = prompting_techniques
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
         self.gold_standard = Data()
 
         # Metrics we want to keep track of
@@ -36,55 +110,206 @@ class EvaluationFrameWork:
         # Attempt at some new metrics
         self.confusion_matrices = {model.name: {technique: None for technique in technique_names} for model in models}
 
+        # The missing, extra and duplicate documents of each response file
+        self.alignment = {model.name: {technique: None for technique in technique_names} for model in models}
+
     def evaluate(self, include_indices=True):
         """
         Evaluates the performance of the models.
+        The response files are evaluated in parallel processes, in one chunk per process (see evaluate_files), and the results are cached per file,
+        keyed by the content of the response file and the gold standard, so unchanged files are never evaluated again.
         """
         self.include_indices = include_indices
+        gold_hash = file_hash(self.gold_standard.data_path)
+
+        # Collect the response files, and the cached results
+        paths = {}
+        cache_paths = {}
+        results = {}
         for model in self.models:
             for prompting_technique in self.prompting_techniques:
                 # Filler prompt to get the correct data
                 prompt = prompting_technique(text="Filler", data=self.gold_standard, model=model)
-                print(f"Evaluating model: {model.name} for prompting technique: {prompt.name}")
-                path = f"data/responses/{model.name}_{prompt.name}.jsonl"
+                path = find_data_file(f"data/responses/{model.name}_{prompt.name}.jsonl")
 
                 try:
-                    data = Data(data_path=path)
+                    key = hashlib.sha256(f"{file_hash(path)}:{gold_hash}:{SCORING_VERSION}".encode()).hexdigest()
                 except FileNotFoundError:
                     print(f"Data for model: {model}, prompting technique: {prompting_technique} not found, skipping.")
                     continue
-                
-                # Sort both data such that they are in the same order
-                data = sorted(data, key=lambda x: x[0])
-                gold_standard = sorted(self.gold_standard, key=lambda x: x[0])
 
-                # G = Gold Standard labels, P = Predicted labels
-                P = [label for _, label in data]
-                G = [label for _, label in gold_standard]
-
-                # Fix uppercase error in "Nothing" of the predicted labels
-                for p in P:
-                    for label in p:
-                        if label.name == "Nothing":
-                            label.name = "nothing"
-                    # Remove exact duplicates from the predicted labels
-                    p = set(p)
+                paths[(model.name, prompt.name)] = path
+                cache_paths[(model.name, prompt.name)] = os.path.join(self.cache_dir, f"{key}.json")
+                try:
+                    with open(cache_paths[(model.name, prompt.name)], "r") as f:
+                        results[(model.name, prompt.name)] = json.load(f)
+                except FileNotFoundError:
+                    pass
+
+        # Evaluate the files that are not cached
+        runs = [run for run in paths if run not in results]
+        print(f"Evaluating {len(runs)} response files ({len(paths) - len(runs)} cached)")
+        if runs:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Every worker scores its chunk of files together, instead of one file at a time
+            num_chunks = min(self.num_workers or os.cpu_count() or 1, len(runs))
+            chunks = [runs[i::num_chunks] for i in range(num_chunks)]
+            with ProcessPoolExecutor(max_workers=num_chunks) as executor:
+                evaluated = executor.map(evaluate_files, [[paths[run] for run in chunk] for chunk in chunks], [self.gold_standard.data_path] * num_chunks)
+                for chunk, chunk_results in zip(chunks, evaluated):
+                    for run, result in zip(chunk, chunk_results):
+                        results[run] = result
+                        # Write atomically, such that an interrupted run does not leave a broken cache file
+                        with open(cache_paths[run] + ".tmp", "w") as f:
+                            json.dump(result, f)
+                        os.replace(cache_paths[run] + ".tmp", cache_paths[run])
+            # In the order of the models and prompting techniques, as the chunks are interleaved
+            results = {run: results[run] for run in paths}
+
+        self.scores = {}
+        for (model_name, technique_name), result in results.items():
+            print(f"Evaluating model: {model_name} for prompting technique: {technique_name}")
+            report = result["alignment"]
+            self.alignment[model_name][technique_name] = report
+            if any(report.values()):
+                print(f"Missing: {len(report['missing'])}, extra: {len(report['extra'])}, duplicate: {len(report['duplicate'])} documents, scoring the matched documents.")
+
+            for span_mode, (precision, recall) in result["scores"].items():
+                self.scores[(model_name, technique_name, span_mode == "True")] = (precision, recall)
+            precision, recall = self.scores[(model_name, technique_name, include_indices)]
+            f1 = self.calculate_f1_score(precision, recall)
+
+            print(f"Precision: {precision}, Recall: {recall}, F1: {f1}")
+
+            # Save the f1 metrics
+            self.precision[model_name][technique_name] = precision
+            self.recall[model_name][technique_name] = recall
+            self.f1[model_name][technique_name] = f1
+
+            # -- Extra metrics --
+            # Store confusion matrix
+            self.confusion_matrices[model_name][technique_name] = {'matrix': np.array(result["matrix"], dtype=int), 'classes': result["classes"]}
+
+    @staticmethod
+    def score_runs(runs: dict) -> dict:
+        """
+        Vectorised version of calculate_precision and calculate_recall, for many runs at once.
 
-                precision = self.calculate_precision(P, G, include_indices)
-                recall = self.calculate_recall(P, G, include_indices)
-                f1 = self.calculate_f1_score(precision, recall)
+        All predicted and gold standard labels of all runs are encoded as arrays (document, start, end, label code),
+        the comparison scores of all (predicted, gold standard) pairs within the same document are computed at once,
+        and then reduced to the precision and recall of each run.
 
-                print(f"Precision: {precision}, Recall: {recall}, F1: {f1}")
+        parameters:
+        - runs: dict, run key (e.g. (model name, technique name)) -> (P, G), the predicted and gold standard labels per document
 
-                # Save the f1 metrics
-                self.precision[model.name][prompt.name] = precision
-                self.recall[model.name][prompt.name] = recall
-                self.f1[model.name][prompt.name] = f1
+        returns a dict: (run key, include_indices) -> (precision, recall) (the run key is unpacked if it is a tuple)
+        """
+        keys = list(runs)
+        class_codes = {}
+        P_documents, G_documents, run_of_document = [], [], []
+        for run, key in enumerate(keys):
+            P, G = runs[key]
+            # Only documents that are in both (as zip does in calculate_precision and calculate_recall)
+            num_documents = min(len(P), len(G))
+            P_documents += P[:num_documents]
+            G_documents += G[:num_documents]
+            run_of_document += [run] * num_documents
+        run_of_document = np.array(run_of_document, dtype=np.int64)
+        num_documents = len(run_of_document)
+
+        p_doc, p_start, p_end, p_code = EvaluationFrameWork.encode_labels(P_documents, class_codes)
+        g_doc, g_start, g_end, g_code = EvaluationFrameWork.encode_labels(G_documents, class_codes)
+        nothing = class_codes.get("nothing", -1)
+
+        # All (predicted, gold standard) pairs within the same document
+        # (the labels are ordered by document, so the gold standard labels of a document are contiguous)
+        g_counts = np.bincount(g_doc, minlength=num_documents)
+        g_offsets = np.concatenate(([0], np.cumsum(g_counts)))
+        pairs_per_p = g_counts[p_doc]
+        pair_p = np.repeat(np.arange(len(p_doc)), pairs_per_p)
+        pair_start = np.repeat(np.cumsum(pairs_per_p) - pairs_per_p, pairs_per_p)
+        pair_g = g_offsets[p_doc][pair_p] + np.arange(len(pair_p)) - pair_start
+
+        # Comparison scores of the pairs (see _comparison), without and with indices
+        delta = (p_code[pair_p] == g_code[pair_g]).astype(np.float64)
+        p_length = EvaluationFrameWork.span_lengths(p_start, p_end)
+        g_length = EvaluationFrameWork.span_lengths(g_start, g_end)
+        intersection = np.minimum(p_end[pair_p], g_end[pair_g]) - np.maximum(p_start[pair_p], g_start[pair_g]) + 1
+        intersection = np.where((p_length[pair_p] > 0) & (g_length[pair_g] > 0), np.maximum(intersection, 0), 0)
+        h = p_length[pair_p] + g_length[pair_g] - intersection
+        jaccard = np.divide(intersection, h, out=np.zeros(len(h)), where=h > 0)
+
+        scores = {}
+        for include_indices, pair_scores in ((False, delta), (True, jaccard * delta)):
+            # Precision: the best score of each predicted label, averaged per document (0 if there are no predictions)
+            p_best = np.zeros(len(p_doc))
+            np.maximum.at(p_best, pair_p, pair_scores)
+            p_counts = np.bincount(p_doc, minlength=num_documents)
+            p_sums = np.bincount(p_doc, weights=p_best, minlength=num_documents)
+            document_precision = np.divide(p_sums, p_counts, out=np.zeros(num_documents), where=p_counts > 0)
+
+            # Recall: the best score of each gold standard label except 'nothing', averaged per document (1 if there are none)
+            g_best = np.zeros(len(g_doc))
+            np.maximum.at(g_best, pair_g, pair_scores)
+            g_minus = g_code != nothing
+            g_minus_counts = np.bincount(g_doc[g_minus], minlength=num_documents)
+            g_minus_sums = np.bincount(g_doc[g_minus], weights=g_best[g_minus], minlength=num_documents)
+            document_recall = np.divide(g_minus_sums, g_minus_counts, out=np.ones(num_documents), where=g_minus_counts > 0)
+
+            # Average over the documents of each run
+            documents_per_run = np.bincount(run_of_document, minlength=len(keys))
+            precision = np.bincount(run_of_document, weights=document_precision, minlength=len(keys)) / documents_per_run
+            recall = np.bincount(run_of_document, weights=document_recall, minlength=len(keys)) / documents_per_run
+            for run, key in enumerate(keys):
+                run_key = key if isinstance(key, tuple) else (key,)
+                scores[run_key + (include_indices,)] = (float(precision[run]), float(recall[run]))
+        return scores
+
+    @staticmethod
+    def encode_labels(documents: List, class_codes: dict) -> tuple:
+        """
+        Encode the labels of the given documents as arrays: document index, start, end and label code.
+        Label codes are the (lowercase) label names, numbered in class_codes (which is extended with new names).
+        """
+        doc, start, end, code = [], [], [], []
+        for i, labels in enumerate(documents):
+            for label in labels:
+                doc.append(i)
+                start.append(label.start)
+                end.append(label.end)
+                code.append(class_codes.setdefault(label.name.lower(), len(class_codes)))
+        return (np.array(doc, dtype=np.int64), np.array(start, dtype=np.int64),
+                np.array(end, dtype=np.int64), np.array(code, dtype=np.int64))
+
+    @staticmethod
+    def span_lengths(start: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """ Vectorised Label.length: the number of indices of each span (0 for -1/-1)."""
+        return np.where((start == -1) & (end == -1), 0, np.maximum(end - start + 1, 0))
+
+    @staticmethod
+    def align(data: Data, gold_labels: List, gold_index: dict) -> tuple:
+        """
+        Match the documents of the responses to the gold standard by the hash of their text.
+        Only the first response of a document is used, documents that are not in both are left out.
 
-                # -- Extra metrics --
-                # Compute and store confusion matrix
-                cm, classes = self.compute_confusion_matrix(P, G)
-                self.confusion_matrices[model.name][prompt.name] = {'matrix': cm, 'classes': classes}
+        Returns the predicted labels (P), the gold standard labels (G) of the matched documents,
+        and a report with the missing, extra and duplicate documents (as indices in the gold standard and the responses).
+        """
+        P, G = [], []
+        report = {"missing": [], "extra": [], "duplicate": []}
+        matched = set()
+        for i, (text, labels) in enumerate(data):
+            j = gold_index.get(text_hash(text))
+            if j is None:
+                report["extra"].append(i)
+            elif j in matched:
+                report["duplicate"].append(i)
+            else:
+                matched.add(j)
+                P.append(labels)
+                G.append(gold_labels[j])
+        report["missing"] = [j for j in range(len(gold_labels)) if j not in matched]
+        return P, G, report
 
     def calculate_f1_score(self, precision, recall):
         """
@@ -155,12 +380,13 @@ class EvaluationFrameWork:
         Otherwise, just compare label names.
         """
         if include_indices:
-            intersection = len(p.indices().intersection(g.indices()))
+            # The spans are intervals, so the sizes are computed directly from the start and end indices
+            intersection = p.overlap(g)
             # In the code of the MAFALDA paper, they give three options for h (as defined in the paper): PRED_SIZE, GOLD_SIZE, and JACCARD_INDEX.
             # We choose JACCARD_INDEX (as this is their default). Which they calculate as:
             # h = len(p_indices) + len(g_indices) - intersection
             # This is the same as the Jaccard index, which is the intersection divided by the union.
-            h = len(p.indices()) + len(g.indices()) - intersection
+            h = p.length() + g.length() - intersection
         else:
             # If we do not include indices, we just compare the label names, 
             intersection = self.delta(p, g)  # Intersection is 1 if the names are the same, 0 otherwise.
@@ -219,7 +445,8 @@ class EvaluationFrameWork:
 ## NB: These metrics were created with the help of Github Copilot (AI pair programming tool) due to time constraints and the complexity of the task.
 ## ------------------------------------------------
 
-    def compute_confusion_matrix(self, P, G):
+    @staticmethod
+    def compute_confusion_matrix(P, G):
         """
         Compute the confusion matrix for each class.
         """
@@ -1,12 +1,22 @@
 """
 Here the experiment is defined, which consists of running all prompting techniques on all models.
 """
-from data import Data
+from data import Data, open_data_file, text_hash
 from typing import List
 from util import get_all_models, get_all_prompting_techniques
-from fallacy_extraction import extract_fallacies
+from fallacy_extraction import extract_fallacies_with_path
+from collections import Counter
 from models.model import Model
 from prompting_techniques.prompt import Prompt
+from response_writer import ResponseWriter
+from glob import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
 
 
 class Experiment:
@@ -16,9 +26,19 @@ class Experiment:
     parameters:
     - models: List, the models to collect data for
     - prompting_techniques: List, the prompting techniques to collect data for
+    - batch_size: int, the number of prompts that are passed to the model at once (Optional, default is 8)
+    - invariant_first: bool, whether to put the parts of the prompt that are the same for every text first, such that the models can cache them (Optional, default is False)
+    - resume: bool, whether to continue from the existing responses (and checkpoints) instead of starting over (Optional, default is False)
+    - pipelined: bool, whether to build the prompts and write the responses on background threads while the model generates (Optional, default is False)
+    - queue_size: int, the maximum number of batches waiting between two stages of the pipelined run (Optional, default is 4)
+    - flush_every: int, the number of responses after which the written responses are flushed and checkpointed (Optional, default is 64)
+    - flush_interval: float, the number of seconds after which the written responses are flushed and checkpointed (Optional, default is 5.0)
+    - compress: bool, whether to also write a gzip compressed copy of each response file (Optional, default is False)
+    - shard_index: int, the shard of the work to run, each shard writes its own response files to data/shards (Optional, default is 0)
+    - num_shards: int, the number of shards the work is split into, by the hash of the model, technique and text (Optional, default is 1)
     """
 
-    def __init__(self, data: Data = Data(), models: List[Model] = None, prompting_techniques: List[Prompt] = None):
+    def __init__(self, data: Data = Data(), models: List[Model] = None, prompting_techniques: List[Prompt] = None, batch_size: int = 8, invariant_first: bool = False, resume: bool = False, pipelined: bool = False, queue_size: int = 4, flush_every: int = 64, flush_interval: float = 5.0, compress: bool = False, shard_index: int = 0, num_shards: int = 1):
         # Default to all models and prompting techniques if none are given
         if models is None:
             models = get_all_models()
@@ -28,6 +48,20 @@ class Experiment:
         self.data = data
         self.models = models
         self.prompting_techniques = prompting_techniques
+        self.batch_size = batch_size
+        self.invariant_first = invariant_first
+        self.resume = resume
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.compress = compress
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"Shard index {shard_index} is not in the range of {num_shards} shards")
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        # Throughput and queue depth metrics of the latest run, per (model name, prompting technique name)
+        self.metrics = {}
 
     def run(self):
         """
@@ -39,21 +73,349 @@ class Experiment:
                 # Filler prompt to log and clear existing data
                 prompt = prompting_technique(text="Filler", data=self.data, model=model)
                 print(f"Running experiment {model.name} for prompting technique: {prompt.name}")
-                open(f"data/responses/{model.name}_{prompt.name}.jsonl", "w").close()
+                path, checkpoint_path = self.get_paths(model.name, prompt.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
 
-                # Loop over data
-                for text, labels in self.data:
-                    # Copy data to avoid modifying the original
-                    # data = self.data.copy()
+                # Collect the texts first, as building the prompts may shuffle the data
+                texts = [text for text, labels in self.data]
+                if self.num_shards > 1:
+                    texts = [text for text in texts if get_shard(model.name, prompt.name, text, self.num_shards) == self.shard_index]
 
-                    # Generate prompt
-                    prompt = prompting_technique(text=text, data=self.data, model=model)
+                # The responses are written to a partial file, which replaces the response file once all texts are done
+                writer = ResponseWriter(path, flush_every=self.flush_every, flush_interval=self.flush_interval, compress=self.compress, resume=self.resume)
 
-                    # Pass to model
-                    response = model.generate_response(str(prompt))
+                # Skip the texts that already have a response (if resuming), otherwise start over
+                done = self.load_progress(writer.partial_path, checkpoint_path) if self.resume else []
+                if not self.resume and os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
+                done_hashes = set(done)
+                texts = [text for text in texts if text_hash(text) not in done_hashes]
+                # Everything that is flushed is on disk, so a restarted run can continue from there
+                writer.on_flush = lambda flushed: self.save_checkpoint(writer.partial_path, checkpoint_path, len(done) + flushed)
+                print(f"{len(done)} texts already done, {len(texts)} to go")
 
-                    # Extract fallacies from response
-                    fallacies = extract_fallacies(response)
+                # Let the model cache the start of the prompt that is the same for every text
+                prompt.invariant_first = self.invariant_first
+                model.cache_prefix(prompt.get_prefix())
+                model.set_max_new_tokens(prompt.max_new_tokens)
 
-                    # Model.write_response
-                    model.write_response(prompt=prompt, labels=fallacies, prompting_technique=prompt.name)
\ No newline at end of file
+                # Process the texts in batches: build the prompts, generate the responses, then extract and write them
+                # (models that generate several batches at the same time get that many batches at once)
+                step = self.batch_size * model.parallelism
+                batches = [texts[i:i + step] for i in range(0, len(texts), step)]
+                progress = Progress(writer)
+                complete = False
+                try:
+                    if self.pipelined:
+                        self.run_pipelined(model, prompting_technique, batches, progress)
+                    else:
+                        self.run_sequential(model, prompting_technique, batches, progress)
+                    complete = True
+                finally:
+                    writer.close(complete=complete)
+
+                metrics = progress.metrics()
+                self.metrics[(model.name, prompt.name)] = metrics
+                print(f"Building the prompts needed {progress.model_calls} extra model calls")
+                print(f"Extraction paths of the responses: {dict(progress.extractions)}")
+                print(f"Throughput: {metrics['texts_per_second']:.2f} texts/s, time per stage: {metrics['stage_seconds']}")
+                if self.pipelined:
+                    print(f"Queue depths: {metrics['queue_depth']}")
+
+            report = model.get_performance_report()
+            if report:
+                print(f"Performance of {model.name}: {report}")
+
+    def get_paths(self, model_name: str, technique_name: str) -> tuple:
+        """
+        The paths of the response file and the checkpoint of a run, per shard if the work is sharded (see merge_shards).
+        """
+        if self.num_shards == 1:
+            return f"data/responses/{model_name}_{technique_name}.jsonl", f"data/checkpoints/{model_name}_{technique_name}.json"
+        shard = f"{self.shard_index}-of-{self.num_shards}"
+        return f"data/shards/{model_name}_{technique_name}/{shard}.jsonl", f"data/checkpoints/{model_name}_{technique_name}_{shard}.json"
+
+    def run_sequential(self, model: Model, prompting_technique, batches: List[List[str]], progress: "Progress"):
+        """
+        Runs the batches one after the other, each stage waits for the previous one.
+        """
+        for batch in batches:
+            prompts = self.build_prompts(model, prompting_technique, batch, progress)
+            responses, stats = self.generate(model, prompts, progress)
+            self.write(model, prompts, responses, stats, progress)
+
+    def run_pipelined(self, model: Model, prompting_technique, batches: List[List[str]], progress: "Progress"):
+        """
+        Runs the stages at the same time, connected by bounded queues: the prompts are built on a background thread,
+        the responses are generated on this thread, and the responses are extracted and written on another background thread.
+        This way the model does not wait for the prompt building, extraction and writing (which run on the CPU).
+        """
+        prompt_queue = queue.Queue(maxsize=self.queue_size)
+        response_queue = queue.Queue(maxsize=self.queue_size)
+        # Set when a stage fails, such that the other stages stop as well
+        failed = threading.Event()
+        # Prompts may need the model while they are built, so the model is only used by one thread at a time
+        model_lock = threading.Lock()
+        errors = []
+
+        def build():
+            try:
+                for batch in batches:
+                    prompts = self.build_prompts(model, prompting_technique, batch, progress, model_lock)
+                    if not put(prompt_queue, prompts, failed):
+                        return
+                put(prompt_queue, None, failed)
+            except BaseException as exception:
+                errors.append(exception)
+                failed.set()
+
+        def write():
+            try:
+                while True:
+                    item = get(response_queue, failed)
+                    if item is None:
+                        return
+                    progress.sample_queue_depth("responses", response_queue.qsize() + 1)
+                    self.write(model, *item, progress)
+            except BaseException as exception:
+                errors.append(exception)
+                failed.set()
+
+        builder = threading.Thread(target=build, daemon=True)
+        writer = threading.Thread(target=write, daemon=True)
+        builder.start()
+        writer.start()
+        try:
+            while True:
+                prompts = get(prompt_queue, failed)
+                if prompts is None:
+                    break
+                progress.sample_queue_depth("prompts", prompt_queue.qsize() + 1)
+                with model_lock:
+                    responses, stats = self.generate(model, prompts, progress)
+                if not put(response_queue, (prompts, responses, stats), failed):
+                    break
+            put(response_queue, None, failed)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            builder.join()
+            writer.join()
+        if errors:
+            raise errors[0]
+
+    def build_prompts(self, model: Model, prompting_technique, batch: List[str], progress: "Progress", model_lock: threading.Lock = None) -> List[Prompt]:
+        """
+        Builds and renders the prompts of a batch of texts (which may need model calls).
+        """
+        start = time.perf_counter()
+        prompts = [prompting_technique(text=text, data=self.data, model=model) for text in batch]
+        for prompt in prompts:
+            prompt.invariant_first = self.invariant_first
+            prompt.model_lock = model_lock
+            prompt.render()
+        progress.add_time("build", start)
+        progress.model_calls += sum(prompt.model_calls for prompt in prompts)
+        return prompts
+
+    def generate(self, model: Model, prompts: List[Prompt], progress: "Progress") -> tuple:
+        """
+        Passes the prompts to the model as a batch (the rendered prompts are cached, so this is also what gets logged).
+        """
+        start = time.perf_counter()
+        responses = model.generate_responses([str(prompt) for prompt in prompts], batch_size=self.batch_size, final_answer=True)
+        stats = model.latest_stats
+        progress.add_time("generate", start)
+        return responses, stats
+
+    def write(self, model: Model, prompts: List[Prompt], responses: List[str], stats: List[dict], progress: "Progress"):
+        """
+        Extracts the fallacies from the responses and writes them (the writer checkpoints the progress whenever it flushes).
+        """
+        start = time.perf_counter()
+        for prompt, response, response_stats in zip(prompts, responses, stats):
+            # Extract fallacies from response
+            fallacies, extraction = extract_fallacies_with_path(response)
+            progress.extractions[extraction] += 1
+
+            # Model.write_response
+            model.write_response(prompt=prompt, labels=fallacies, prompting_technique=prompt.name, response=response, extraction=extraction, stats=response_stats, writer=progress.writer)
+        progress.add_time("write", start)
+
+    def load_progress(self, path: str, checkpoint_path: str) -> list:
+        """
+        Get the hashes of the texts that already have a response (one per response).
+        The responses are first truncated to the size in the checkpoint (if any), to drop a partially written response.
+        The checkpoint is only trusted if the responses up to that size are as many as the checkpoint says were completed,
+        otherwise (e.g. the file was written after the checkpoint) only a partially written last line is dropped.
+        """
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            checkpoint = None
+
+        with open(path, "r+b") as f:
+            content = f.read()
+            if checkpoint is not None and content[:checkpoint["size"]].count(b"\n") == checkpoint["completed"]:
+                content = content[:checkpoint["size"]]
+            else:
+                if checkpoint is not None:
+                    print(f"The checkpoint {checkpoint_path} does not match {path}, continuing from its complete lines")
+                # Without a (matching) checkpoint, at least drop a partially written last line
+                content = content[:content.rfind(b"\n") + 1]
+            f.truncate(len(content))
+        return [text_hash(text) for text, labels in Data(data_path=path)]
+
+    def save_checkpoint(self, path: str, checkpoint_path: str, completed: int):
+        """
+        Atomically write the progress: the size of the (partial) responses file after the last flush and the number of responses
+        in it (see load_progress).
+        """
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        checkpoint = {"size": os.path.getsize(path), "completed": completed}
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+# The shard response files, see Experiment.get_paths
+SHARD_PATTERN = re.compile(r"(\d+)-of-(\d+)\.jsonl$")
+
+
+def get_shard(model_name: str, technique_name: str, text: str, num_shards: int) -> int:
+    """ The shard of a text for a model and prompting technique, which is the same in every process (unlike hash)."""
+    key = f"{model_name}\n{technique_name}\n{text_hash(text)}"
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def merge_shards(data: Data, shard_dir: str = "data/shards", compress: bool = False) -> dict:
+    """
+    Combine the shard response files of each run (model and prompting technique) into its response file in data/responses,
+    in the order of the data. A run is only merged if it is complete: all shards are finished and every text has a response.
+    Returns the coverage of each run: the shards that are missing or unfinished, and the number of missing and extra responses
+    (empty if no shard was run).
+    """
+    if not os.path.isdir(shard_dir):
+        return {}
+    texts = [text for text, labels in data]
+    report = {}
+    for run in sorted(os.listdir(shard_dir)):
+        shard_paths = {}
+        num_shards = set()
+        for path in glob(os.path.join(shard_dir, run, "*-of-*.jsonl")):
+            index, num = SHARD_PATTERN.search(path).groups()
+            shard_paths[int(index)] = path
+            num_shards.add(int(num))
+        if len(num_shards) != 1:
+            report[run] = {"complete": False, "error": f"shard files of different numbers of shards: {sorted(num_shards)}"}
+            continue
+        num_shards = num_shards.pop()
+        unfinished = sorted(int(SHARD_PATTERN.search(path[:-len(".partial")]).group(1))
+                            for path in glob(os.path.join(shard_dir, run, "*-of-*.jsonl.partial")))
+
+        # The responses per text, in the order they were written
+        records = {}
+        for index in sorted(shard_paths):
+            with open_data_file(shard_paths[index]) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records.setdefault(text_hash(record["text"]), []).append(record)
+
+        # Take the responses in the order of the data (a text that occurs twice has two responses)
+        merged = []
+        missing = 0
+        for text in texts:
+            responses = records.get(text_hash(text))
+            if responses:
+                merged.append(responses.pop(0))
+            else:
+                missing += 1
+        extra = sum(len(responses) for responses in records.values())
+
+        coverage = {
+            "shards": num_shards,
+            "missing_shards": sorted(set(range(num_shards)) - set(shard_paths)),
+            "unfinished_shards": unfinished,
+            "responses": len(merged),
+            "missing": missing,
+            "extra": extra
+        }
+        coverage["complete"] = not coverage["missing_shards"] and not unfinished and missing == 0 and extra == 0
+        if coverage["complete"]:
+            writer = ResponseWriter(f"data/responses/{run}.jsonl", compress=compress)
+            for record in merged:
+                writer.write(record)
+            writer.close()
+        report[run] = coverage
+    return report
+
+
+class Progress:
+    """
+    The progress of the run of a model and prompting technique: the writer of the responses, and the metrics of the stages.
+
+    parameters:
+    - writer: ResponseWriter, the writer of the response file
+    """
+    def __init__(self, writer: ResponseWriter):
+        self.writer = writer
+        self.model_calls = 0
+        self.extractions = Counter()
+
+        self.start = time.perf_counter()
+        self.texts = 0
+        self.stage_seconds = Counter()
+        # The number of batches in each queue (including the batch that was just taken), sampled whenever a batch is taken
+        self.queue_depths = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, stage: str, start: float):
+        with self.lock:
+            self.stage_seconds[stage] += time.perf_counter() - start
+
+    def sample_queue_depth(self, name: str, depth: int):
+        with self.lock:
+            self.queue_depths.setdefault(name, []).append(depth)
+
+    def metrics(self) -> dict:
+        """ The throughput (texts per second), the time spent in each stage, and the mean and maximum queue depths."""
+        elapsed = time.perf_counter() - self.start
+        texts = sum(self.extractions.values())
+        return {
+            "texts": texts,
+            "seconds": round(elapsed, 3),
+            "texts_per_second": texts / elapsed if elapsed > 0 else 0.0,
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+            "queue_depth": {
+                name: {"mean": round(sum(depths) / len(depths), 2), "max": max(depths)}
+                for name, depths in self.queue_depths.items()
+            }
+        }
+
+
+def put(q: queue.Queue, item, failed: threading.Event) -> bool:
+    """ Put an item on the queue, waiting while it is full. Returns False if another stage failed in the meantime."""
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def get(q: queue.Queue, failed: threading.Event):
+    """ Get an item from the queue, waiting while it is empty. Returns None if another stage failed in the meantime."""
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
@@ -3,6 +3,8 @@ Functionalities + dictionaries to extract fallacies from a text.
 """
 
 import re
+from bisect import bisect_left
+from collections import Counter
 
 NON_FALLACIES_REGEX = r"\b(?:does not contain|no|none|not|false|nothing|is not part|not necessarily part|no fallacious|not fallacious)\b"
 
@@ -158,37 +160,185 @@ LEVEL_2_CLUSTERS = [
     "appeal to emotion"
 ]
 
+NON_FALLACY_PATTERN = re.compile(NON_FALLACIES_REGEX, re.IGNORECASE)
+
+# The keyword patterns, indexed by the first word of the keyword (keywords start at the start of a word, as they start with \b and a letter).
+# This way the text is scanned only once (word by word), and only the keywords starting with that word are checked.
+def build_keyword_patterns():
+    keyword_patterns = {}
+    keywords = [(fallacy, keyword) for fallacy, keywords in COMBINED_LEVEL_2.items() for keyword in keywords]
+    for order, (fallacy, keyword) in enumerate(keywords):
+        first_word = re.match(r'\w+', keyword).group().lower()
+        keyword_patterns.setdefault(first_word, []).append((order, fallacy, re.compile(r'\b{}\b'.format(keyword), re.IGNORECASE)))
+    return keyword_patterns
+
+KEYWORD_PATTERNS = build_keyword_patterns()
+
+WORD_PATTERN = re.compile(r'\w+')
+INDEX_PATTERN = re.compile(r'\d+')
+
+
+# The structured output format: [fallacy_type, start, end] tuples (see Prompt.get_standard_format), the names may be quoted
+TUPLE_PATTERN = re.compile(r"""\[\s*(['"]?)([^\[\],'"\n]+?)\1\s*,\s*(\d+)\s*,\s*(\d+)\s*\]""")
+EMPTY_LIST_PATTERN = re.compile(r"\[\s*\]")
+SEPARATOR_PATTERN = re.compile(r"[\s,]*")
+# A tuple that is cut off at the end of the response (e.g. by max_new_tokens), the name must be complete
+TRUNCATED_TUPLE_PATTERN = re.compile(r"""\[\s*(['"]?)([^\[\],'"\n]+?)\1\s*,\s*(?:(\d+)\s*,\s*)?\d*\s*$""")
+# Several tuples flattened into a single list, e.g. [ad hominem, 10, 20, straw man, 30, 40], and each of its tuples
+FLAT_TRIPLE = r"""['"]?[^\[\],'"\n]+?['"]?\s*,\s*\d+\s*,\s*\d+"""
+FLAT_LIST_PATTERN = re.compile(r"\[\s*" + FLAT_TRIPLE + r"(?:\s*,\s*" + FLAT_TRIPLE + r")+\s*\]")
+FLAT_TUPLE_PATTERN = re.compile(r"""(['"]?)([^\[\],'"\n]+?)\1\s*,\s*(\d+)\s*,\s*(\d+)""")
+
+# How often each extraction path was used: structured (the output format), keywords (the fallback) or none (nothing found)
+EXTRACTION_STATS = Counter()
+
+
 def extract_fallacies(text):
+    """
+    Extract fallacies from the given text.
+    The structured output format is parsed first, if the response does not follow it the keywords are used instead.
+    """
+    fallacies, path = extract_fallacies_with_path(text)
+    return fallacies
+
+
+def extract_fallacies_with_path(text):
+    """
+    Extract fallacies from the given text, and also return which path extracted them: "structured", "keywords" or "none".
+    """
+    fallacies = parse_structured(text)
+    if fallacies is not None:
+        path = "structured"
+    else:
+        fallacies = extract_fallacies_keywords(text)
+        path = "keywords" if fallacies else "none"
+    EXTRACTION_STATS[path] += 1
+    return fallacies, path
+
+
+def parse_structured(text):
+    """
+    Parse the [fallacy_type, start, end] tuples of the first list in the response (text before it, e.g. reasoning, is skipped).
+    Parsing stops at the first text that is not a tuple (e.g. an explanation), a tuple that is cut off at the end
+    of the response is kept if its fallacy type is complete (with -1 for the missing indices).
+    An empty list is parsed as "Nothing" (as with the keywords). Returns None if the response has no such list, or if a
+    fallacy type is not one of the known fallacies (see normalize_fallacy), such that the keywords are used instead.
+    """
+    position = text.find("[")
+    while position != -1:
+        tuples = parse_tuples(text, position)
+        if tuples is not None:
+            break
+        position = text.find("[", position + 1)
+    else:
+        return None
+
+    fallacies = []
+    for start, end, name in tuples:
+        fallacy = normalize_fallacy(name)
+        if fallacy is None:
+            return None
+        fallacies.append([start, end, fallacy])
+    if not fallacies:
+        fallacies.append([0, 0, "Nothing"])
+    return fallacies
+
+
+def parse_tuples(text, position):
+    """
+    Parse the (start, end, name) tuples of the list that starts at the given position (see parse_structured),
+    returns None if there is no list of tuples (or empty list) there.
+    """
+    # Allow the tuples to be wrapped in an outer list
+    if text.startswith("[[", position) or re.match(r"\[\s+\[", text[position:position + 20]):
+        position = SEPARATOR_PATTERN.match(text, position + 1).end()
+
+    tuples = []
+    parsed = False
+    while position < len(text):
+        match = TUPLE_PATTERN.match(text, position)
+        if match is not None:
+            tuples.append((int(match.group(3)), int(match.group(4)), match.group(2)))
+        else:
+            match = FLAT_LIST_PATTERN.match(text, position) or EMPTY_LIST_PATTERN.match(text, position)
+            if match is None:
+                match = TRUNCATED_TUPLE_PATTERN.match(text, position)
+                if match is not None:
+                    start = int(match.group(3)) if match.group(3) is not None else -1
+                    tuples.append((start, -1, match.group(2)))
+                    parsed = True
+                break
+            for flat_match in FLAT_TUPLE_PATTERN.finditer(match.group()):
+                tuples.append((int(flat_match.group(3)), int(flat_match.group(4)), flat_match.group(2)))
+        parsed = True
+        position = SEPARATOR_PATTERN.match(text, match.end()).end()
+
+    if not parsed:
+        return None
+    return tuples
+
+
+def normalize_fallacy(name):
+    """
+    Map a fallacy type from the structured output to one of the fallacies in COMBINED_LEVEL_2 (using the keywords),
+    returns None if it is not a known fallacy.
+    """
+    name = name.strip().lower().replace("_", " ")
+    if name in COMBINED_LEVEL_2:
+        return name
+    fallacies = extract_fallacies_keywords(name)
+    if fallacies and fallacies[0][2] != "Nothing":
+        return fallacies[0][2]
+    return None
+
+
+def extract_fallacies_keywords(text):
     """
     Extract fallacies from the given text. (based on the MAFALDA paper, which provided the dictionaries and the regex pattern)
+
+    All keywords are found in a single scan over the words of the text, and each keyword is paired with the first two
+    numbers after it (the numbers are found in a single scan as well). The fallacies are returned in the order of the fallacies
+    and keywords in COMBINED_LEVEL_2, as before.
     """
-    non_fallacy_pattern = re.compile(NON_FALLACIES_REGEX, re.IGNORECASE)
+    # The numbers (start positions and values) in the text, in order
+    number_starts, numbers = [], []
+    for match in INDEX_PATTERN.finditer(text):
+        number_starts.append(match.start())
+        numbers.append(int(match.group()))
 
     # Store the found/not found fallacies
     fallacies_found = []
-    fallacy_found = False
-
-    # Loop through the fallacies and their keywords and check if they are present in the text
-    for fallacy, keywords in COMBINED_LEVEL_2.items():
-        for keyword in keywords:
-            regex_pattern = r'\b{}\b'.format(keyword)
-            for match in re.finditer(regex_pattern, text, re.IGNORECASE):
-                
-                # If match is found also attempt to extract the indices of the location of the fallacy with pattern \d+
-                index_pattern = r'\d+'
-                indices = re.findall(index_pattern, text[match.end():], re.IGNORECASE)
-
-                # We store not found indices as -1 to indicate that we did not find the indices
-                if len(indices) < 2:
-                    indices += [-1] * (2 - len(indices))
-
-                # Store fallacy
-                fallacies_found.append([int(indices[0]), int(indices[1]), fallacy])
-                fallacy_found = True
+    for word in WORD_PATTERN.finditer(text):
+        for order, fallacy, pattern in KEYWORD_PATTERNS.get(word.group().lower(), []):
+            match = pattern.match(text, word.start())
+            if match is None:
+                continue
+
+            # If match is found also attempt to extract the indices of the location of the fallacy (the next two numbers)
+            next_number = bisect_left(number_starts, match.end())
+            indices = numbers[next_number:next_number + 2]
+
+            # We store not found indices as -1 to indicate that we did not find the indices
+            if len(indices) < 2:
+                indices += [-1] * (2 - len(indices))
+
+            # Store fallacy (with its order, for sorting)
+            fallacies_found.append((order, match.start(), [indices[0], indices[1], fallacy]))
+
+    # Same order as looping over the fallacies and their keywords
+    fallacies_found = [fallacy for _, _, fallacy in sorted(fallacies_found, key=lambda found: found[:2])]
 
     # If no fallacies are found, check for non-fallacies
-    if not fallacy_found:
-        if non_fallacy_pattern.search(text):
+    if not fallacies_found:
+        if NON_FALLACY_PATTERN.search(text):
             fallacies_found.append([0, 0, "Nothing"])
 
-    return fallacies_found
\ No newline at end of file
+    return fallacies_found
+
+
+def extract_fallacies_many(texts):
+    """
+    Extract the fallacies of many texts at once (e.g. to re-extract stored responses).
+    See EXTRACTION_STATS for the paths that were used.
+    """
+    return [extract_fallacies(text) for text in texts]
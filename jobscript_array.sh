@@ -0,0 +1,23 @@
+#!/bin/bash
+# Runs the experiment as a SLURM array, one shard per task. Submit the merge after all tasks succeeded:
+#   sbatch --dependency=afterok:<array job id> --wrap "python main.py merge"
+#SBATCH --time=03:00:00
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --mem=40000
+#SBATCH --gres=gpu:a100:1
+#SBATCH --partition=gpu
+#SBATCH --array=0-3
+
+module purge
+module load Python/3.11.3-GCCcore-12.3.0
+
+source $HOME/venvs/ltp/bin/activate
+
+# Store the checkpoints in the local model cache, such that loading them is fast. Only the first task converts a checkpoint,
+# the other tasks wait for it (the cache is locked), and a checkpoint that is already stored is skipped
+python main.py prepare
+
+python main.py complete --resume --shard-index $SLURM_ARRAY_TASK_ID --num-shards $SLURM_ARRAY_TASK_COUNT
+
+deactivate
@@ -6,9 +6,15 @@ from prompting_techniques.generated_knowledge import GeneratedKnowledge
 from models.test import RandomModel
 from models.falcon import Falcon
 from models.zephyr import Zephyr
-from experiment import Experiment
+from models.registry import ModelRegistry, CHECKPOINTS
+from models.checkpoints import get_dtype, prepare_checkpoint
+from models.server import ServerModel
+from models.cache import CachedModel
+from models.pool import ModelPool, parse_replicas
+from experiment import Experiment, merge_shards
 from evaluation import EvaluationFrameWork
 import sys
+import torch
 
 
 if __name__ == "__main__":
@@ -16,6 +22,30 @@ if __name__ == "__main__":
     if len(sys.argv) == 1:
         sys.argv.append("evaluate")
 
+    # Continue from the existing responses instead of starting over
+    resume = "--resume" in sys.argv
+    # Only let the models generate lists of [fallacy_type, start, end] tuples
+    constrained = "--constrained" in sys.argv
+    # Build the prompts and write the responses on background threads while the model generates
+    pipelined = "--pipelined" in sys.argv
+    # Also write gzip compressed copies of the response files
+    compress = "--compress" in sys.argv
+    # Only run one shard of the work (e.g. one task of a SLURM array), the shards are combined with merge
+    shard_index = int(sys.argv[sys.argv.index("--shard-index") + 1]) if "--shard-index" in sys.argv else 0
+    num_shards = int(sys.argv[sys.argv.index("--num-shards") + 1]) if "--num-shards" in sys.argv else 1
+    # Run a replica of each model per device (in separate processes), e.g. "cuda:0,cuda:1" or "cpu:0-3,cpu:4-7"
+    replicas = parse_replicas(sys.argv[sys.argv.index("--devices") + 1]) if "--devices" in sys.argv else None
+    # Quantize the linear layers of the models to int8 (on the CPU), and the number of threads torch uses on the CPU
+    quantize = "--quantize" in sys.argv
+    num_threads = int(sys.argv[sys.argv.index("--threads") + 1]) if "--threads" in sys.argv else None
+    # Use the models served by an OpenAI-compatible server instead of loading them, e.g. "http://localhost:8000/v1/completions"
+    server_url = sys.argv[sys.argv.index("--server") + 1] if "--server" in sys.argv else None
+    # The memory (in GB) the loaded weights may take, by default only one checkpoint is loaded at a time
+    memory_budget = int(float(sys.argv[sys.argv.index("--memory-budget") + 1]) * 1024 ** 3) if "--memory-budget" in sys.argv else None
+
+    # The dtype to prepare the checkpoints in, by default the one they are loaded in on this machine (e.g. "bfloat16" for the GPUs)
+    dtype = sys.argv[sys.argv.index("--dtype") + 1] if "--dtype" in sys.argv else None
+
     # Load the data
     data = Data()
     model = RandomModel()
@@ -43,9 +73,16 @@ if __name__ == "__main__":
         print(prompt)
         print(gen_knowledge_prompt)
     elif sys.argv[1] == "experiment":
-        # Just run the experiment to get the data
-        experiment = Experiment(data, models=[model])
-        experiment.run()
+        # Just run the experiment to get the data (the random responses are not cached, as they would be replayed in every run)
+        experiment_model = ModelPool(RandomModel, replicas) if replicas else model
+        experiment = Experiment(data, models=[experiment_model], resume=resume, pipelined=pipelined, compress=compress,
+                                shard_index=shard_index, num_shards=num_shards)
+        try:
+            experiment.run()
+        finally:
+            # Stop the replica processes, also if the experiment failed
+            if replicas:
+                experiment_model.close()
     elif sys.argv[1] == "evaluate":
         # Evaluate the model
         evaluation_framework = EvaluationFrameWork()
@@ -53,11 +90,48 @@ if __name__ == "__main__":
         evaluation_framework.plot()
     elif sys.argv[1] == "complete":
         # Run the experiment and evaluate the models
-        model_falcon = Falcon()
-        model_zephyr = Zephyr()
-        experiment = Experiment(data, models=[model_falcon, model_zephyr])
-        experiment.run()
-        
+        model_kwargs = {"constrained_decoding": constrained, "quantize": quantize, "num_threads": num_threads}
+        # The pools of replica processes, which are stopped once the experiment is done
+        pools = []
+        if server_url:
+            model_falcon = CachedModel(ServerModel("Falcon", CHECKPOINTS["Falcon"], url=server_url))
+            model_zephyr = CachedModel(ServerModel("Zephyr", CHECKPOINTS["Zephyr"], url=server_url))
+        elif replicas:
+            pools = [ModelPool(Falcon, replicas, model_kwargs), ModelPool(Zephyr, replicas, model_kwargs)]
+            model_falcon, model_zephyr = [CachedModel(pool) for pool in pools]
+        else:
+            # The weights are only loaded once needed (not at all if all responses are cached), and shared by checkpoint
+            registry = ModelRegistry(memory_budget=memory_budget)
+            model_falcon = CachedModel(registry.get("Falcon", **model_kwargs))
+            model_zephyr = CachedModel(registry.get("Zephyr", **model_kwargs))
+        experiment = Experiment(data, models=[model_falcon, model_zephyr], resume=resume, pipelined=pipelined, compress=compress,
+                                shard_index=shard_index, num_shards=num_shards)
+        try:
+            experiment.run()
+        finally:
+            for pool in pools:
+                pool.close()
+        print(f"Response cache: {model_falcon.stats()}, {model_zephyr.stats()}")
+        if num_shards > 1:
+            print("Only a shard of the experiment was run, merge the shards before evaluating")
+            sys.exit(0)
+
         evaluation_framework = EvaluationFrameWork(models=[model_falcon, model_zephyr])
         evaluation_framework.evaluate()
         evaluation_framework.plot()
+    elif sys.argv[1] == "merge":
+        # Combine the responses of the shards into the response files
+        report = merge_shards(data, compress=compress)
+        if not report:
+            print("No shards found, run the experiment with --shard-index and --num-shards first")
+            sys.exit(1)
+        for run, coverage in report.items():
+            print(f"{run}: {coverage}")
+        if not all(coverage["complete"] for coverage in report.values()):
+            print("Not all runs are complete, these are not merged")
+            sys.exit(1)
+    elif sys.argv[1] == "prepare":
+        # Store the checkpoints (converted to safetensors in the dtype they are loaded in) in the local model cache
+        for checkpoint in sorted(set(CHECKPOINTS.values())):
+            path = prepare_checkpoint(checkpoint, getattr(torch, dtype) if dtype else get_dtype())
+            print(f"{checkpoint}: {path}")
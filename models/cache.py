@@ -0,0 +1,175 @@
+"""
+Persistent prompt -> response cache, to not generate the same response twice (across runs).
+"""
+
+from concurrent.futures import Future
+from typing import List
+from models.model import Model
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    Responses stored in SQLite by key, evicting the least recently used responses once the total size exceeds max_size.
+
+    Parameters:
+    - path: str, the path to the SQLite database (Optional, default is data/response_cache.sqlite)
+    - max_size: int, the maximum total size of the responses in bytes (Optional, default is 1 GB)
+    """
+    def __init__(self, path: str = "data/response_cache.sqlite", max_size: int = 1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+
+    def get(self, key: str) -> str:
+        """ Get the response of the key (None if it is not cached)."""
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        """ Store the response of the key, and evict the least recently used responses if the cache is too large."""
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time())
+            )
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            while total > self.max_size:
+                key, size = self.connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        """ The hit/miss counters, and the number and total size of the cached responses."""
+        with self.lock:
+            count, total = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "responses": count, "size": total}
+
+
+class CachedModel(Model):
+    """
+    Wraps a model such that its responses are cached, keyed by the model name, checkpoint, generation settings and prompt.
+    Identical prompts that are requested at the same time (in one batch, or from several threads) are only generated once.
+
+    Parameters:
+    - model: Model, the model to cache the responses of
+    - cache: ResponseCache, the cache to use (Optional, default is the default ResponseCache)
+    """
+    def __init__(self, model: Model, cache: ResponseCache = None):
+        super().__init__(name=model.name, model=model.checkpoint)
+        self.wrapped = model
+        self.parallelism = model.parallelism
+        self.cache = cache if cache is not None else ResponseCache()
+        self.collapsed = 0
+
+        # Prompts that are being generated right now, per key
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def key(self, prompt: str, final_answer: bool = False) -> str:
+        """ The cache key of a prompt."""
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        settings = self.wrapped.get_generation_settings()
+        # Only the final answers may be stopped early, the other responses get their own keys (the final answers keep theirs)
+        if not final_answer:
+            settings["final_answer"] = False
+        key = json.dumps([self.wrapped.name, self.wrapped.checkpoint, settings, prompt_hash], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def generate_response(self, prompt: str) -> str:
+        """
+        Generates a response to some given prompt (or gets it from the cache)
+        """
+        return self.generate_responses([prompt], batch_size=1)[0]
+
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts (or gets them from the cache), the uncached prompts are passed on in batches.
+        """
+        keys = [self.key(prompt, final_answer) for prompt in prompts]
+        results = {}
+        to_generate = {}
+        generated_stats = {}
+        waiting = {}
+        for key, prompt in zip(keys, prompts):
+            if key in results or key in to_generate or key in waiting:
+                self.collapsed += 1
+                continue
+            response = self.cache.get(key)
+            if response is not None:
+                results[key] = response
+                continue
+
+            # Wait for the response if another thread is already generating it, otherwise generate it ourselves
+            with self.lock:
+                if key in self.in_flight:
+                    waiting[key] = self.in_flight[key]
+                    self.collapsed += 1
+                else:
+                    self.in_flight[key] = Future()
+                    to_generate[key] = prompt
+
+        if to_generate:
+            try:
+                responses = self.wrapped.generate_responses(list(to_generate.values()), batch_size=batch_size, final_answer=final_answer)
+            except BaseException as exception:
+                with self.lock:
+                    for key in to_generate:
+                        self.in_flight.pop(key).set_exception(exception)
+                raise
+
+            stats = self.wrapped.latest_stats or [{} for _ in responses]
+            for key, response, response_stats in zip(to_generate, responses, stats):
+                self.cache.put(key, response)
+                results[key] = response
+                generated_stats[key] = response_stats
+                with self.lock:
+                    self.in_flight.pop(key).set_result(response)
+
+        for key, future in waiting.items():
+            results[key] = future.result()
+
+        responses = [results[key] for key in keys]
+        # Only the responses that were generated right now have generation stats
+        self.latest_stats = [generated_stats.pop(key, {"stop_reason": "cached"}) for key in keys]
+        if responses:
+            self.latest_response = responses[-1]
+        return responses
+
+    def cache_prefix(self, prefix: str):
+        self.wrapped.cache_prefix(prefix)
+
+    def set_max_new_tokens(self, max_new_tokens: int):
+        self.wrapped.set_max_new_tokens(max_new_tokens)
+
+    def get_generation_settings(self) -> dict:
+        return self.wrapped.get_generation_settings()
+
+    def get_performance_report(self) -> dict:
+        return self.wrapped.get_performance_report()
+
+    def stats(self) -> dict:
+        """ The cache counters, including the number of requests that were collapsed into another request."""
+        return {**self.cache.stats(), "collapsed": self.collapsed}
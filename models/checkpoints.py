@@ -0,0 +1,67 @@
+"""
+Local cache of the HuggingFace checkpoints, converted to safetensors in the dtype they are loaded in, such that a model
+is loaded from the local disk (memory-mapped, without converting the weights or contacting the hub) instead of from the
+HuggingFace cache. The cache is filled with `python main.py prepare`.
+"""
+
+import fcntl
+import os
+import shutil
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# The directory of the converted checkpoints, one directory per checkpoint and dtype
+MODEL_CACHE_DIR = "data/model_cache"
+
+
+def get_dtype(device: str = None) -> torch.dtype:
+    """ The dtype the weights are loaded in on a device (None is all GPUs, or the CPU if there are none)."""
+    if device is None and not torch.cuda.is_available():
+        device = "cpu"
+    # bfloat16 is only fast on GPUs
+    return torch.float32 if device == "cpu" else torch.bfloat16
+
+
+def get_cache_path(checkpoint: str, dtype: torch.dtype, cache_dir: str = MODEL_CACHE_DIR) -> str:
+    """ The directory of a checkpoint in the cache, e.g. data/model_cache/HuggingFaceH4--zephyr-7b-beta-bfloat16."""
+    name = checkpoint.strip("/").replace("/", "--")
+    return os.path.join(cache_dir, f"{name}-{str(dtype).replace('torch.', '')}")
+
+
+def find_cached_checkpoint(checkpoint: str, dtype: torch.dtype, cache_dir: str = MODEL_CACHE_DIR) -> str:
+    """ The directory of a checkpoint in the cache, or None if it was not prepared."""
+    path = get_cache_path(checkpoint, dtype, cache_dir)
+    return path if os.path.isdir(path) else None
+
+
+def prepare_checkpoint(checkpoint: str, dtype: torch.dtype, cache_dir: str = MODEL_CACHE_DIR) -> str:
+    """
+    Convert a checkpoint (with its tokenizer) to safetensors in the given dtype and store it in the cache,
+    returns the directory it is stored in. A checkpoint that is already in the cache is not converted again.
+
+    parameters:
+    - checkpoint: str, the HuggingFace checkpoint (or a local directory) to convert
+    - dtype: torch.dtype, the dtype to store the weights in (see get_dtype)
+    - cache_dir: str, the directory of the cache (Optional, default is data/model_cache)
+    """
+    path = get_cache_path(checkpoint, dtype, cache_dir)
+    if os.path.isdir(path):
+        return path
+
+    # Only one process converts a checkpoint (e.g. of the tasks of a SLURM array), the others wait for it and then find it
+    # in the cache. The lock is released when the file is closed, also if the process dies.
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isdir(path):
+            return path
+
+        # Written to a temporary directory first, such that a failed conversion does not leave a partial checkpoint
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        model = AutoModelForCausalLM.from_pretrained(checkpoint, torch_dtype=dtype, low_cpu_mem_usage=True)
+        tokenizer.save_pretrained(tmp_path)
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        os.rename(tmp_path, path)
+    return path
@@ -0,0 +1,169 @@
+"""
+Constrained decoding, such that the model can only generate [fallacy_type, start, end] tuples in the output format of
+the prompt (see Prompt.get_standard_format), e.g. [ad hominem, 12, 40], [straw man, 3, 9] or [].
+The tuples may also be enclosed in a list and the labels may be quoted, e.g. [['ad hominem', 12, 40]].
+"""
+
+import torch
+from fallacy_extraction import LEVEL_2_CLUSTERS
+from transformers import LogitsProcessor
+
+# The state of the grammar once the list is closed, only the end of sequence can follow
+DONE = ("done",)
+# The maximum number of digits of the start and end indices
+MAX_DIGITS = 6
+
+
+class TupleGrammar:
+    """
+    The grammar of the output list, and the tokens of the vocabulary that are allowed in each of its states.
+    The allowed tokens are found by walking a trie over the (decoded) tokens of the vocabulary together with the grammar,
+    such that only the branches of the trie that the grammar accepts are visited. They are cached per state.
+
+    Parameters:
+    - tokenizer: the tokenizer of the model
+    - labels: List[str], the fallacy types that are allowed (Optional, default is LEVEL_2_CLUSTERS)
+    """
+    def __init__(self, tokenizer, labels=LEVEL_2_CLUSTERS):
+        self.labels = set(labels)
+        self.label_prefixes = {label[:i] for label in labels for i in range(len(label) + 1)}
+        self.eos_token_id = tokenizer.eos_token_id
+
+        # The text of each token, decoded after another token, as some tokenizers drop the leading space of the first token
+        anchor = tokenizer("a", add_special_tokens=False)["input_ids"]
+        anchor_text = tokenizer.decode(anchor)
+        self.token_texts = {}
+        special_ids = set(tokenizer.all_special_ids)
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                continue
+            text = tokenizer.decode(anchor + [token_id])
+            if text.startswith(anchor_text) and len(text) > len(anchor_text):
+                self.token_texts[token_id] = text[len(anchor_text):]
+
+        # Character trie over the token texts, the token ids that end at a node are stored under None
+        self.trie = {}
+        for token_id, text in self.token_texts.items():
+            node = self.trie
+            for character in text:
+                node = node.setdefault(character, {})
+            node.setdefault(None, []).append(token_id)
+
+        self.allowed = {}
+
+    def advance(self, state: tuple, character: str):
+        """
+        The state after the character, or None if the grammar does not allow the character.
+        The last element of the states within the list is whether the tuples are in an enclosing list ([[...], [...]]),
+        or follow each other as in the prompt ([...], [...]), such that the tuples may end without a closing bracket.
+        """
+        kind = state[0]
+        if kind == "start":
+            # A single space or newline is allowed before the list
+            if character in " \n":
+                return ("bracket",)
+            return ("list",) if character == "[" else None
+        if kind == "bracket":
+            return ("list",) if character == "[" else None
+        if kind == "list":
+            if character == "]":
+                return DONE
+            if character == "[":
+                return ("open", True)
+            # The first bracket opened the first tuple itself
+            return self.advance(("open", False), character)
+        if kind == "open":
+            # The label is either quoted ('ad hominem') or not (ad hominem), as in the prompt
+            if character == "'":
+                return ("label", "", True, state[1])
+            return ("label", character, False, state[1]) if character in self.label_prefixes else None
+        if kind == "label":
+            label, quoted, enclosed = state[1], state[2], state[3]
+            if quoted and character == "'":
+                return ("comma", 0, enclosed) if label in self.labels else None
+            if not quoted and character == ",":
+                return ("space", 0, enclosed) if label in self.labels else None
+            return ("label", label + character, quoted, enclosed) if label + character in self.label_prefixes else None
+        if kind == "comma":
+            return ("space", state[1], state[2]) if character == "," else None
+        if kind == "space":
+            return ("index", state[1], 0, state[2]) if character == " " else None
+        if kind == "index":
+            index, digits, enclosed = state[1], state[2], state[3]
+            if character.isdigit() and character.isascii():
+                return ("index", index, digits + 1, enclosed) if digits < MAX_DIGITS else None
+            if digits == 0:
+                return None
+            if index == 0:
+                return ("space", 1, enclosed) if character == "," else None
+            return ("next", enclosed) if character == "]" else None
+        if kind == "next":
+            if character == "]" and state[1]:
+                return DONE
+            return ("separator", state[1]) if character == "," else None
+        if kind == "separator":
+            return ("tuple", state[1]) if character == " " else None
+        if kind == "tuple":
+            return ("open", state[1]) if character == "[" else None
+        return None
+
+    def advance_token(self, state: tuple, token_id: int):
+        """ The state after the token, or None if the grammar does not allow the token."""
+        for character in self.token_texts.get(token_id, ""):
+            state = self.advance(state, character)
+            if state is None:
+                return None
+        return state
+
+    def allowed_tokens(self, state: tuple) -> list:
+        """
+        The token ids that are allowed in the state, the end of sequence is allowed once the list is closed,
+        and after each tuple that is not in an enclosing list.
+        """
+        if state in self.allowed:
+            return self.allowed[state]
+
+        allowed = []
+        stack = [(self.trie, state)]
+        while stack:
+            node, node_state = stack.pop()
+            for character, child in node.items():
+                if character is None:
+                    continue
+                child_state = self.advance(node_state, character)
+                if child_state is None:
+                    continue
+                allowed += child.get(None, [])
+                stack.append((child, child_state))
+
+        if state == DONE or state == ("next", False) or not allowed:
+            allowed.append(self.eos_token_id)
+        self.allowed[state] = allowed
+        return allowed
+
+
+class TupleLogitsProcessor(LogitsProcessor):
+    """
+    Masks the logits of all tokens that the grammar does not allow, for each sequence of a batch.
+
+    Parameters:
+    - grammar: TupleGrammar, the grammar of the output list
+    - prompt_length: int, the length of the (padded) prompts, after which the generated tokens start
+    """
+    def __init__(self, grammar: TupleGrammar, prompt_length: int):
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        # The grammar state of each sequence, and the number of generated tokens it includes
+        self.states = {}
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        mask = torch.full_like(scores, float("-inf"))
+        for i, generated in enumerate(input_ids[:, self.prompt_length:].tolist()):
+            state, length = self.states.get(i, (("start",), 0))
+            for token_id in generated[length:]:
+                # Tokens after the list is closed are the end of sequence and padding
+                if state != DONE:
+                    state = self.grammar.advance_token(state, token_id) or DONE
+            self.states[i] = (state, len(generated))
+            mask[i, self.grammar.allowed_tokens(state)] = 0
+        return scores + mask
@@ -1,44 +1,21 @@
-import torch
-from models.model import Model
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from models.huggingface import HuggingFaceModel
+from models.registry import CHECKPOINTS
 
 
-class Falcon(Model):
+class Falcon(HuggingFaceModel):
     """
     This class is used to handle the Falcon model.
 
-    No parameters are needed.
+    parameters:
+    - prefix_caching: bool, whether to reuse the key/values of the shared prompt prefix (Optional, default is True)
+    - early_stopping: bool, whether to stop generating once the answer is complete (Optional, default is True)
+    - constrained_decoding: bool, whether the model can only generate a list of [fallacy_type, start, end] tuples (Optional, default is False)
+    - device: str, the device to load the model on, e.g. "cuda:1" or "cpu" (Optional, by default the model is spread over all GPUs, or on the CPU if there are none)
+    - quantize: bool, whether to quantize the linear layers to int8 (dynamic quantisation, only on the CPU) (Optional, default is False)
+    - num_threads: int, the number of threads torch uses on the CPU (Optional, default is the torch default)
     """
-    def __init__(self):
-        super().__init__(name="Falcon", model="HuggingFaceH4/zephyr-7b-beta")
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model,
-            torch_dtype=torch.bfloat16,
-            device_map="auto"
-        )
-
-    def generate_response(self, prompt):
-        """
-        Generates a response to some given prompt
-        """
-        # Encode it
-        inputs = self.tokenizer.encode(
-            prompt,
-            return_tensors="pt"
-        ).to("cuda")
-
-        # Generate the output
-        outputs = self.model.generate(
-            inputs,
-            max_new_tokens=50,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-
-        # Decode and return the output
-        self.latest_response = self.tokenizer.decode(
-            outputs[0][inputs.shape[1]:],
-            skip_special_tokens=True
-        )
-
-        return self.latest_response
+    def __init__(self, prefix_caching: bool = True, early_stopping: bool = True, constrained_decoding: bool = False,
+                 device: str = None, quantize: bool = False, num_threads: int = None):
+        super().__init__(name="Falcon", model=CHECKPOINTS["Falcon"], prefix_caching=prefix_caching,
+                         early_stopping=early_stopping, constrained_decoding=constrained_decoding, device=device,
+                         quantize=quantize, num_threads=num_threads)
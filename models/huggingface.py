@@ -0,0 +1,254 @@
+import copy
+import resource
+import time
+import torch
+from typing import List
+from models.model import Model
+from models.constrained import TupleGrammar, TupleLogitsProcessor
+from models.stopping import AnswerCompleteCriteria
+from models.checkpoints import get_dtype, find_cached_checkpoint
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList, StoppingCriteriaList
+
+
+class HuggingFaceModel(Model):
+    """
+    This is the superclass for all models that are loaded from the HuggingFace hub.
+    It handles the tokenizer, the (batched) generation and the decoding.
+
+    Parameters:
+    - name: str, the name of the model.
+    - model: str, the HuggingFace checkpoint to load.
+    - prefix_caching: bool, whether to reuse the key/values of the shared prompt prefix (Optional, default is True)
+    - early_stopping: bool, whether to stop generating once the answer is complete (Optional, default is True)
+    - constrained_decoding: bool, whether the model can only generate a list of [fallacy_type, start, end] tuples (Optional, default is False)
+    - device: str, the device to load the model on, e.g. "cuda:1" or "cpu" (Optional, by default the model is spread over all GPUs, or on the CPU if there are none)
+    - quantize: bool, whether to quantize the linear layers to int8 (dynamic quantisation, only on the CPU) (Optional, default is False)
+    - num_threads: int, the number of threads torch uses on the CPU (Optional, default is the torch default)
+    """
+    def __init__(self, name: str, model: str, prefix_caching: bool = True, early_stopping: bool = True,
+                 constrained_decoding: bool = False, device: str = None, quantize: bool = False, num_threads: int = None):
+        super().__init__(name=name, model=model)
+        self.generation_kwargs = {"max_new_tokens": 50}
+
+        # Run on the CPU if there is no GPU
+        if device is None and not torch.cuda.is_available():
+            device = "cpu"
+        if quantize and device != "cpu":
+            raise ValueError("Dynamic int8 quantisation is only supported on the CPU")
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        # Load from the local cache if the checkpoint was prepared in this dtype (see models/checkpoints.py)
+        dtype = get_dtype(device)
+        self.loaded_from = find_cached_checkpoint(self.checkpoint, dtype) or self.checkpoint
+        # The seconds each phase of loading took (see get_performance_report)
+        self.load_seconds = {}
+
+        start = time.perf_counter()
+        self.tokenizer = AutoTokenizer.from_pretrained(self.loaded_from)
+        self.load_seconds["tokenizer"] = time.perf_counter() - start
+
+        # The weights are loaded straight onto the device(s), without a detour over the CPU
+        start = time.perf_counter()
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.loaded_from,
+            torch_dtype=dtype,
+            device_map=device if device is not None else "auto"
+        )
+        self.load_seconds["weights"] = time.perf_counter() - start
+
+        # Placing the weights: the copies to the GPU(s) may still be running, and any weights that were not loaded onto the
+        # device are moved there (nothing is moved if all of them are)
+        start = time.perf_counter()
+        if device is not None:
+            self.model.to(device)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.load_seconds["placement"] = time.perf_counter() - start
+
+        # The weights of the linear layers are stored in int8, the activations are quantized on the fly
+        self.quantize = quantize
+        if quantize:
+            start = time.perf_counter()
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.load_seconds["quantize"] = time.perf_counter() - start
+        # The inputs go to the device of the first layers
+        self.device = self.model.device
+
+        # Batched decoding needs left padding, so that all prompts end at the same position
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # The prefix shared by the prompts, its token ids and its past key/values (per batch size)
+        self.prefix_caching = prefix_caching
+        self.prefix = None
+        self.prefix_ids: List[int] = []
+        self.prefix_cache = {}
+
+        self.early_stopping = early_stopping
+
+        # The grammar of the output list is only built when it is used, as it decodes the whole vocabulary
+        self.constrained_decoding = constrained_decoding
+        self.grammar = None
+
+        # The number of generated tokens and the time spent generating them (see get_performance_report)
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+
+    def get_generation_settings(self) -> dict:
+        """
+        The generation kwargs, and whether the responses are stopped early, constrained or generated by a quantized model.
+        """
+        settings = {**self.generation_kwargs, "early_stopping": self.early_stopping, "constrained_decoding": self.constrained_decoding}
+        # Only included when quantized, such that the responses cached before quantisation existed keep their keys
+        if self.quantize:
+            settings["quantize"] = True
+        return settings
+
+    def get_performance_report(self) -> dict:
+        """
+        The device, where the model was loaded from and how long each phase of loading took, the generation speed
+        (in tokens per second over all generate calls) and the peak memory use of the process.
+        """
+        return {
+            "device": str(self.device),
+            "loaded_from": self.loaded_from,
+            "load_seconds": {phase: round(seconds, 3) for phase, seconds in self.load_seconds.items()},
+            "quantized": self.quantize,
+            "threads": torch.get_num_threads(),
+            "generated_tokens": self.generated_tokens,
+            "seconds": round(self.generation_seconds, 3),
+            "tokens_per_second": round(self.generated_tokens / self.generation_seconds, 2) if self.generation_seconds > 0 else 0.0,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+
+    def cache_prefix(self, prefix: str):
+        """
+        Sets the prefix of which the past key/values are reused for all prompts that start with it.
+        The key/values themselves are only computed once for each batch size, on first use.
+        """
+        if not self.prefix_caching or prefix == self.prefix:
+            return
+        self.prefix = prefix
+        self.prefix_ids = self.tokenizer(prefix)["input_ids"]
+        self.prefix_cache = {}
+
+    def get_prefix_cache(self, batch_size: int):
+        """
+        Returns a copy of the past key/values of the prefix for the given batch size (as generation extends them in place).
+        """
+        if batch_size not in self.prefix_cache:
+            prefix_ids = torch.tensor([self.prefix_ids] * batch_size, device=self.device)
+            with torch.no_grad():
+                self.prefix_cache[batch_size] = self.model(prefix_ids, use_cache=True).past_key_values
+        return copy.deepcopy(self.prefix_cache[batch_size])
+
+    def generate_response(self, prompt: str) -> str:
+        """
+        Generates a response to some given prompt
+        """
+        return self.generate_responses([prompt], batch_size=1)[0]
+
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts, in batches of (at most) batch_size prompts.
+        Only the final answers are stopped once they are complete (if early_stopping is set), and constrained to the output
+        format (if constrained_decoding is set).
+        """
+        responses = []
+        self.latest_stats = []
+        for i in range(0, len(prompts), batch_size):
+            batch = prompts[i:i + batch_size]
+            if self.prefix is not None and all(prompt.startswith(self.prefix) for prompt in batch):
+                batch_responses, batch_stats = self._generate_batch_with_prefix(batch, final_answer)
+            else:
+                batch_responses, batch_stats = self._generate_batch(batch, final_answer)
+            responses += batch_responses
+            self.latest_stats += batch_stats
+
+        if responses:
+            self.latest_response = responses[-1]
+        return responses
+
+    def _generate_batch(self, batch: List[str], final_answer: bool = False) -> tuple:
+        """
+        Generates the responses for a single batch of prompts.
+        """
+        # Encode the batch (left padded)
+        inputs = self.tokenizer(
+            batch,
+            return_tensors="pt",
+            padding=True
+        ).to(self.device)
+
+        return self._generate(inputs["input_ids"], inputs["attention_mask"], final_answer=final_answer)
+
+    def _generate_batch_with_prefix(self, batch: List[str], final_answer: bool = False) -> tuple:
+        """
+        Generates the responses for a single batch of prompts that all start with the cached prefix.
+        Only the remainder of each prompt is prefilled, padding is placed between the prefix and the remainder.
+        """
+        # The prefix only tokenizes the same within the full prompt if it ends on a token boundary
+        prefix_length = len(self.prefix_ids)
+        encoded = self.tokenizer(batch)["input_ids"]
+        if any(ids[:prefix_length] != self.prefix_ids for ids in encoded):
+            return self._generate_batch(batch, final_answer)
+
+        suffixes = [ids[prefix_length:] for ids in encoded]
+        width = max(len(suffix) for suffix in suffixes)
+        input_ids = []
+        attention_mask = []
+        for suffix in suffixes:
+            padding = width - len(suffix)
+            input_ids.append(self.prefix_ids + [self.tokenizer.pad_token_id] * padding + suffix)
+            attention_mask.append([1] * prefix_length + [0] * padding + [1] * len(suffix))
+        input_ids = torch.tensor(input_ids, device=self.device)
+        attention_mask = torch.tensor(attention_mask, device=self.device)
+
+        # Generate the output, only the uncached part of the input is passed through the model
+        return self._generate(input_ids, attention_mask, past_key_values=self.get_prefix_cache(len(batch)), final_answer=final_answer)
+
+    def _generate(self, input_ids, attention_mask, past_key_values=None, final_answer: bool = False) -> tuple:
+        """
+        Generates the output for the encoded batch, and decodes only the newly generated tokens.
+        Returns the responses and their stats (the number of generated tokens and why the generation stopped).
+        """
+        prompt_length = input_ids.shape[1]
+        stopping_criteria = AnswerCompleteCriteria(self.tokenizer, prompt_length)
+        logits_processor = None
+        # Only the final answer has the output format, not e.g. the reasoning or knowledge asked for while building a prompt
+        if self.constrained_decoding and final_answer:
+            if self.grammar is None:
+                self.grammar = TupleGrammar(self.tokenizer)
+            logits_processor = LogitsProcessorList([TupleLogitsProcessor(self.grammar, prompt_length)])
+
+        start = time.perf_counter()
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            stopping_criteria=StoppingCriteriaList([stopping_criteria]) if self.early_stopping and final_answer else None,
+            logits_processor=logits_processor,
+            **self.generation_kwargs,
+            pad_token_id=self.tokenizer.pad_token_id
+        )
+        generated = outputs[:, prompt_length:]
+        self.generation_seconds += time.perf_counter() - start
+
+        stats = []
+        for i, tokens in enumerate(generated.tolist()):
+            # Everything after the end of sequence (or padding, once a sequence is done) is not generated
+            ends = [j for j, token in enumerate(tokens) if token in (self.tokenizer.eos_token_id, self.tokenizer.pad_token_id)]
+            if i in stopping_criteria.stopped:
+                stop_reason = "answer_complete"
+            elif ends:
+                stop_reason = "eos"
+            else:
+                stop_reason = "max_new_tokens"
+            stats.append({"generated_tokens": ends[0] if ends else len(tokens), "stop_reason": stop_reason})
+        self.generated_tokens += sum(response_stats["generated_tokens"] for response_stats in stats)
+
+        responses = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        return responses, stats
@@ -1,6 +1,6 @@
-
 from abc import abstractmethod
 from typing import List
+from response_writer import ResponseWriter
 import json
 
 
@@ -10,23 +10,84 @@ class Model:
 
     Parameters:
     - name: str, the name of the model.
+    - model: str, the checkpoint of the model (Optional)
     """
 
     def __init__(self, name: str, model: str = ""):
         self.name = name
         self.model = model
+        self.checkpoint = model
         self.latest_response: str = ""
+        # The keyword arguments that influence the responses (e.g. the number of new tokens)
+        self.generation_kwargs = {}
+        # Stats of each response of the latest generate_responses call (e.g. the number of generated tokens)
+        self.latest_stats: List[dict] = []
+        # The number of batches the model can generate at the same time (e.g. the number of replicas, see ModelPool)
+        self.parallelism = 1
 
     @abstractmethod
     def generate_response(self, prompt: str) -> str:
         pass
 
-    def write_response(self, prompt: str, labels: List[str], prompting_technique: str):
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts, in batches of (at most) batch_size prompts.
+        By default the prompts are simply passed one by one, subclasses can override this to decode a batch at once.
+        final_answer is set when the prompts ask for the final answer (and not for e.g. reasoning or knowledge while
+        building a prompt), such that models can stop generating once that answer is complete.
+        """
+        responses = []
+        for i in range(0, len(prompts), batch_size):
+            for prompt in prompts[i:i + batch_size]:
+                responses.append(self.generate_response(prompt))
+        self.latest_stats = [{} for _ in responses]
+        return responses
+
+    def set_max_new_tokens(self, max_new_tokens: int):
+        """
+        Sets the token budget of the responses.
+        """
+        self.generation_kwargs["max_new_tokens"] = max_new_tokens
+
+    def get_generation_settings(self) -> dict:
+        """
+        Everything that influences the responses besides the prompt (e.g. to key cached responses with).
+        """
+        return dict(self.generation_kwargs)
+
+    def get_performance_report(self) -> dict:
+        """
+        Performance figures of the model so far (e.g. tokens per second and memory use), empty if the model does not track them.
+        """
+        return {}
+
+    def cache_prefix(self, prefix: str):
+        """
+        Sets the start that (most) of the following prompts share, such that models that support it can cache it.
+        By default nothing is cached.
+        """
+        pass
+
+    def write_response(self, prompt: str, labels: List[str], prompting_technique: str, response: str = None, extraction: str = None, stats: dict = None, writer: ResponseWriter = None):
+        # Default to the latest response if no response is given
+        if response is None:
+            response = self.latest_response
         data = {
             "text": prompt.text,
-            "response": self.latest_response,
-            "labels": labels
+            "response": response,
+            "labels": labels,
+            "model_calls": prompt.model_calls
         }
+        # The way the labels were extracted from the response (see fallacy_extraction.extract_fallacies_with_path)
+        if extraction is not None:
+            data["extraction"] = extraction
+        # Stats of the generation (e.g. the number of generated tokens and why the generation stopped)
+        if stats:
+            data.update(stats)
+        # Write through the (buffered) writer if there is one, otherwise append to the file directly
+        if writer is not None:
+            writer.write(data)
+            return
         json_data = json.dumps(data)
         with open(f"data/responses/{self.name}_{prompting_technique}.jsonl", "a") as f:
-            f.write(json_data + "\n")
\ No newline at end of file
+            f.write(json_data + "\n")
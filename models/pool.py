@@ -0,0 +1,171 @@
+"""
+Pool of model replicas in separate processes, such that several batches are generated at the same time
+(e.g. one replica per GPU, or per set of CPU cores for small models).
+"""
+
+from typing import List
+from models.model import Model
+import inspect
+import multiprocessing
+import os
+import queue
+
+
+def parse_replicas(devices: str) -> List[dict]:
+    """
+    Parse a comma separated list of devices into replicas, e.g. "cuda:0,cuda:1" or "cpu:0-3,cpu:4-7"
+    (a CPU replica can be pinned to a range of cores, or to a single core, e.g. "cpu:3").
+    The cores must be available to this process.
+    """
+    available = os.sched_getaffinity(0)
+    replicas = []
+    for device in devices.split(","):
+        if device.startswith("cpu:"):
+            cores = device[len("cpu:"):]
+            try:
+                first, _, last = cores.partition("-")
+                cores = list(range(int(first), int(last or first) + 1))
+            except ValueError:
+                raise ValueError(f"Invalid CPU cores in {device!r}, expected a core or a range of cores (e.g. cpu:3 or cpu:0-3)")
+            if not cores:
+                raise ValueError(f"The range of CPU cores in {device!r} is empty")
+            if not set(cores) <= available:
+                raise ValueError(f"The cores of {device!r} are not all available, the available cores are {sorted(available)}")
+            replicas.append({"device": "cpu", "cores": cores})
+        else:
+            replicas.append({"device": device})
+    return replicas
+
+
+def run_replica(model_class, model_kwargs: dict, replica: dict, tasks, results):
+    """
+    The loop of a replica process: load the model, then generate the batches from the shared task queue until it is closed.
+    The settings of the pool (prefix and token budget) are sent along with every batch.
+    """
+    try:
+        if "cores" in replica:
+            os.sched_setaffinity(0, replica["cores"])
+            import torch
+            torch.set_num_threads(len(replica["cores"]))
+
+        # Only pass the device to models that can be placed on a device
+        if "device" in replica and "device" in inspect.signature(model_class).parameters:
+            model_kwargs = {**model_kwargs, "device": replica["device"]}
+        model = model_class(**model_kwargs)
+        results.put(("ready", model.name, model.checkpoint, model.get_generation_settings()))
+    except BaseException as exception:
+        results.put(("failed", repr(exception)))
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, prompts, batch_size, final_answer, prefix, max_new_tokens = task
+        try:
+            if prefix is not None:
+                model.cache_prefix(prefix)
+            if max_new_tokens is not None:
+                model.set_max_new_tokens(max_new_tokens)
+            responses = model.generate_responses(prompts, batch_size=batch_size, final_answer=final_answer)
+            results.put((task_id, responses, model.latest_stats))
+        except BaseException as exception:
+            results.put((task_id, repr(exception)))
+
+
+class ModelPool(Model):
+    """
+    Runs a replica of a model in a separate process per device (or set of CPU cores). The batches of prompts are
+    put on a shared queue, from which each replica takes the next batch once it is done, and the responses are returned
+    in the original order.
+
+    Parameters:
+    - model_class: type, the model class to create the replicas of (it is created in each process, so it must be importable)
+    - replicas: List[dict], per replica the device to load the model on and/or the CPU cores to pin the process to (see parse_replicas)
+    - model_kwargs: dict, the keyword arguments for the model class (Optional, default is no arguments)
+    """
+    def __init__(self, model_class, replicas: List[dict], model_kwargs: dict = None):
+        # Spawn instead of fork, as CUDA can not be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=run_replica, args=(model_class, model_kwargs or {}, replica, self.tasks, self.results), daemon=True)
+            for replica in replicas
+        ]
+        for process in self.processes:
+            process.start()
+
+        # Wait until all replicas are loaded, they report the name and settings of the model
+        ready = [self.get_result() for _ in self.processes]
+        failed = [message for message in ready if message[0] == "failed"]
+        if failed:
+            self.close()
+            raise RuntimeError(f"Loading a replica failed: {failed[0][1]}")
+        _, name, checkpoint, generation_settings = ready[0]
+        super().__init__(name=name, model=checkpoint)
+        self.generation_settings = generation_settings
+        self.generation_kwargs = {key: generation_settings[key] for key in ("max_new_tokens",) if key in generation_settings}
+        self.prefix = None
+        # The replicas can each generate a batch at the same time
+        self.parallelism = len(self.processes)
+        self.next_task_id = 0
+
+    def generate_response(self, prompt: str) -> str:
+        """
+        Generates a response to some given prompt
+        """
+        return self.generate_responses([prompt], batch_size=1)[0]
+
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts, the batches of (at most) batch_size prompts are divided over the replicas.
+        """
+        max_new_tokens = self.generation_kwargs.get("max_new_tokens")
+        task_ids = []
+        for i in range(0, len(prompts), batch_size):
+            task_ids.append(self.next_task_id)
+            self.tasks.put((self.next_task_id, prompts[i:i + batch_size], batch_size, final_answer, self.prefix, max_new_tokens))
+            self.next_task_id += 1
+
+        # The results come back in the order the replicas finish them
+        results = {}
+        while len(results) < len(task_ids):
+            result = self.get_result()
+            results[result[0]] = result
+        responses = []
+        self.latest_stats = []
+        for task_id in task_ids:
+            if len(results[task_id]) == 2:
+                raise RuntimeError(f"Generating in a replica failed: {results[task_id][1]}")
+            responses += results[task_id][1]
+            self.latest_stats += results[task_id][2]
+
+        if responses:
+            self.latest_response = responses[-1]
+        return responses
+
+    def get_result(self) -> tuple:
+        """ Wait for the next result of a replica, and stop waiting if a replica process died."""
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    self.close()
+                    raise RuntimeError("A replica process stopped unexpectedly")
+
+    def cache_prefix(self, prefix: str):
+        self.prefix = prefix
+
+    def get_generation_settings(self) -> dict:
+        return {**self.generation_settings, **self.generation_kwargs}
+
+    def close(self):
+        """ Stop the replica processes."""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,171 @@
+"""
+Registry of the HuggingFace models: lightweight handles (name and checkpoint) of which the weights are only loaded once
+they generate. Handles of the same checkpoint share the weights, and the least recently used weights are unloaded
+before other weights are loaded, to stay within the memory budget.
+Nothing in here imports torch, such that the handles can be used (e.g. for their names) without loading anything.
+"""
+
+from collections import OrderedDict
+from typing import List
+from models.model import Model
+import gc
+import sys
+
+# The checkpoint of each model (Falcon uses the Zephyr checkpoint as well, so these share their weights)
+CHECKPOINTS = {
+    "Falcon": "HuggingFaceH4/zephyr-7b-beta",
+    "Zephyr": "HuggingFaceH4/zephyr-7b-beta"
+}
+
+
+class ModelRegistry:
+    """
+    Loads the weights of the model handles on demand, shared by checkpoint (and the device and quantisation).
+
+    parameters:
+    - memory_budget: int, the number of bytes the loaded weights may take, the size of weights that were not loaded before is
+      estimated as the largest loaded weights (Optional, default is None, in which case only one checkpoint is loaded at a time)
+    """
+    def __init__(self, memory_budget: int = None):
+        self.memory_budget = memory_budget
+        # The loaded models, from least to most recently used, and the memory footprint of each key that was loaded
+        self.loaded = OrderedDict()
+        self.footprints = {}
+
+    def get(self, name: str, checkpoint: str = None, **options) -> "ModelHandle":
+        """
+        Get a handle of a model (nothing is loaded yet), the checkpoint defaults to the one in CHECKPOINTS.
+        The options are passed on to the model, see ModelHandle.
+        """
+        return ModelHandle(self, name, checkpoint if checkpoint is not None else CHECKPOINTS[name], **options)
+
+    def load(self, key: tuple):
+        """ The model of the key (checkpoint, device, quantize, num_threads), loaded now if it is not loaded yet."""
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            return self.loaded[key]
+
+        self.make_room(key)
+        from models.huggingface import HuggingFaceModel
+        checkpoint, device, quantize, num_threads = key
+        model = HuggingFaceModel(name=checkpoint, model=checkpoint, device=device, quantize=quantize, num_threads=num_threads)
+        self.loaded[key] = model
+        self.footprints[key] = model.model.get_memory_footprint()
+        return model
+
+    def make_room(self, key: tuple):
+        """ Unload the least recently used models, until the model of the key fits in the memory budget."""
+        if self.memory_budget is None:
+            self.unload_all()
+            return
+        estimate = self.footprints.get(key, max(self.footprints.values(), default=0))
+        while self.loaded and sum(self.footprints[loaded] for loaded in self.loaded) + estimate > self.memory_budget:
+            self.unload(next(iter(self.loaded)))
+
+    def unload(self, key: tuple):
+        """ Free the weights of the key (if loaded), and empty the caches of the GPU."""
+        model = self.loaded.pop(key, None)
+        if model is None:
+            return
+        model.model = None
+        model.prefix_cache = {}
+        del model
+        gc.collect()
+        # torch is loaded, as a model was loaded
+        torch = sys.modules["torch"]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def unload_all(self):
+        for key in list(self.loaded):
+            self.unload(key)
+
+
+class ModelHandle(Model):
+    """
+    Handle of a HuggingFace model in a registry, which only loads the weights once it generates.
+    The weights may be shared with other handles, so the settings of this handle are applied before each use.
+
+    parameters:
+    - registry: ModelRegistry, the registry that loads the weights
+    - name: str, the name of the model
+    - checkpoint: str, the HuggingFace checkpoint to load
+    - device: str, the device to load the model on (Optional, see HuggingFaceModel)
+    - quantize: bool, whether to quantize the linear layers to int8 (Optional, default is False)
+    - num_threads: int, the number of threads torch uses on the CPU (Optional, default is the torch default)
+    - prefix_caching: bool, whether to reuse the key/values of the shared prompt prefix (Optional, default is True)
+    - early_stopping: bool, whether to stop generating once the answer is complete (Optional, default is True)
+    - constrained_decoding: bool, whether the model can only generate a list of [fallacy_type, start, end] tuples (Optional, default is False)
+    """
+    def __init__(self, registry: ModelRegistry, name: str, checkpoint: str, device: str = None, quantize: bool = False,
+                 num_threads: int = None, prefix_caching: bool = True, early_stopping: bool = True, constrained_decoding: bool = False):
+        super().__init__(name=name, model=checkpoint)
+        self.generation_kwargs = {"max_new_tokens": 50}
+        self.registry = registry
+        self.key = (checkpoint, device, quantize, num_threads)
+        self.quantize = quantize
+        self.prefix_caching = prefix_caching
+        self.early_stopping = early_stopping
+        self.constrained_decoding = constrained_decoding
+        self.prefix = None
+
+    def get_model(self):
+        """ The loaded model, with the settings of this handle."""
+        model = self.registry.load(self.key)
+        model.generation_kwargs = dict(self.generation_kwargs)
+        model.prefix_caching = self.prefix_caching
+        model.early_stopping = self.early_stopping
+        model.constrained_decoding = self.constrained_decoding
+        if self.prefix_caching and self.prefix is not None:
+            model.cache_prefix(self.prefix)
+        elif not self.prefix_caching:
+            model.prefix = None
+        return model
+
+    def generate_response(self, prompt: str) -> str:
+        """
+        Generates a response to some given prompt
+        """
+        return self.generate_responses([prompt], batch_size=1)[0]
+
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts, loading the weights first if needed.
+        """
+        model = self.get_model()
+        responses = model.generate_responses(prompts, batch_size=batch_size, final_answer=final_answer)
+        self.latest_stats = model.latest_stats
+        if responses:
+            self.latest_response = responses[-1]
+        return responses
+
+    def cache_prefix(self, prefix: str):
+        """
+        Sets the prefix to cache, which is only passed on to the model once it generates.
+        """
+        self.prefix = prefix
+
+    def get_generation_settings(self) -> dict:
+        """
+        The same settings as those of the HuggingFace model (see HuggingFaceModel.get_generation_settings), without loading it.
+        """
+        settings = {**self.generation_kwargs, "early_stopping": self.early_stopping, "constrained_decoding": self.constrained_decoding}
+        if self.quantize:
+            settings["quantize"] = True
+        return settings
+
+    def get_performance_report(self) -> dict:
+        """
+        The performance report of the loaded model (shared with the handles of the same weights), empty if it is not loaded.
+        """
+        if self.key not in self.registry.loaded:
+            return {}
+        return self.registry.loaded[self.key].get_performance_report()
+
+    def unload(self):
+        """ Free the weights of this handle (and thus of the handles it shares them with)."""
+        self.registry.unload(self.key)
+
+
+# The registry of the handles of get_all_models (see util)
+DEFAULT_REGISTRY = ModelRegistry()
@@ -0,0 +1,226 @@
+"""
+Model that is served by an OpenAI-compatible inference server (e.g. vLLM or TGI), such that the weights are not loaded
+in every process. The requests are sent concurrently with asyncio, over a pool of keep-alive connections.
+"""
+
+from typing import List
+from urllib.parse import urlsplit
+from models.model import Model
+import asyncio
+import json
+import random
+import threading
+import time
+
+# The statuses that are worth retrying (rate limited, or the server is overloaded or restarting)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# The OpenAI finish reasons, as the stop reasons of the HuggingFace models
+STOP_REASONS = {"stop": "eos", "length": "max_new_tokens"}
+
+
+class ServerError(Exception):
+    """ The server responded with an error status."""
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"Server responded with status {status}: {body[:200]!r}")
+        self.status = status
+
+
+class ServerModel(Model):
+    """
+    Talks to the completions endpoint of an OpenAI-compatible server. The requests run on an event loop in a background
+    thread, such that the connections are kept open across calls. At most max_connections requests are sent at the
+    same time, failed requests are retried with exponential backoff, and identical requests that are in flight at the
+    same time are only sent once.
+
+    Parameters:
+    - name: str, the name of the model.
+    - model: str, the name of the model on the server (e.g. the HuggingFace checkpoint).
+    - url: str, the URL of the completions endpoint (Optional, default is http://localhost:8000/v1/completions)
+    - max_connections: int, the maximum number of requests (and open connections) at the same time (Optional, default is 16)
+    - max_retries: int, the number of times a failed request is retried (Optional, default is 3)
+    - backoff: float, the number of seconds to wait before the first retry, doubled for every next retry (Optional, default is 0.5)
+    - timeout: float, the number of seconds after which a request is given up (and retried) (Optional, default is 120)
+    - api_key: str, the key to send as bearer token (Optional, default is no key)
+    """
+    def __init__(self, name: str, model: str, url: str = "http://localhost:8000/v1/completions", max_connections: int = 16,
+                 max_retries: int = 3, backoff: float = 0.5, timeout: float = 120, api_key: str = None):
+        super().__init__(name=name, model=model)
+        self.generation_kwargs = {"max_new_tokens": 50}
+        self.url = urlsplit(url)
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.api_key = api_key
+        # The requests are sent concurrently, so the experiment can pass this many batches at once
+        self.parallelism = max_connections
+
+        # Counters for the performance report
+        self.requests = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.connections_opened = 0
+        self.generated_tokens = 0
+        self.generation_seconds = 0.0
+
+        # The event loop runs in the background, the idle connections and in flight requests belong to it
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.idle_connections = []
+        self.in_flight = {}
+        self.semaphore = None
+
+    def generate_response(self, prompt: str) -> str:
+        """
+        Generates a response to some given prompt
+        """
+        return self.generate_responses([prompt], batch_size=1)[0]
+
+    def generate_responses(self, prompts: List[str], batch_size: int = 8, final_answer: bool = False) -> List[str]:
+        """
+        Generates a response for each of the given prompts, all prompts are sent concurrently (batch_size is left to the server).
+        The server has no stopping criteria for the answer, so final_answer makes no difference.
+        """
+        start = time.perf_counter()
+        max_new_tokens = self.generation_kwargs.get("max_new_tokens")
+        results = asyncio.run_coroutine_threadsafe(self.complete_all(prompts, max_new_tokens), self.loop).result()
+        self.generation_seconds += time.perf_counter() - start
+
+        responses = [response for response, stats in results]
+        self.latest_stats = [stats for response, stats in results]
+        if responses:
+            self.latest_response = responses[-1]
+        return responses
+
+    async def complete_all(self, prompts: List[str], max_new_tokens: int) -> list:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        return await asyncio.gather(*[self.complete(prompt, max_new_tokens) for prompt in prompts])
+
+    async def complete(self, prompt: str, max_new_tokens: int) -> tuple:
+        """ The response to a prompt and its stats, waiting for the identical request if it is already in flight."""
+        key = (prompt, max_new_tokens)
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        task = asyncio.ensure_future(self.request(prompt, max_new_tokens))
+        self.in_flight[key] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.in_flight.pop(key, None)
+
+    async def request(self, prompt: str, max_new_tokens: int) -> tuple:
+        """ Send a completion request, retrying with exponential backoff if the connection or the server fails."""
+        payload = {"model": self.checkpoint, "prompt": prompt, "max_tokens": max_new_tokens, "temperature": 0}
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    status, data = await asyncio.wait_for(self.post(body), self.timeout)
+                self.requests += 1
+                if status == 200:
+                    completion = json.loads(data)
+                    choice = completion["choices"][0]
+                    generated_tokens = completion.get("usage", {}).get("completion_tokens", 0)
+                    self.generated_tokens += generated_tokens
+                    stop_reason = STOP_REASONS.get(choice.get("finish_reason"), choice.get("finish_reason"))
+                    return choice["text"], {"generated_tokens": generated_tokens, "stop_reason": stop_reason}
+                if status not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise ServerError(status, data)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                if attempt == self.max_retries:
+                    raise
+            # Wait a bit longer after every failure, with some jitter such that the retries are spread out
+            self.retries += 1
+            await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+
+    async def post(self, body: bytes) -> tuple:
+        """ POST the body over an idle connection (or a new one), returns the status and the response body."""
+        if self.idle_connections:
+            try:
+                return await self.send(*self.idle_connections.pop(), body)
+            except (OSError, asyncio.IncompleteReadError):
+                # The server may have closed the idle connection (e.g. after its keep-alive timeout), so try a new one
+                pass
+
+        port = self.url.port or (443 if self.url.scheme == "https" else 80)
+        reader, writer = await asyncio.open_connection(self.url.hostname, port, ssl=self.url.scheme == "https")
+        self.connections_opened += 1
+        return await self.send(reader, writer, body)
+
+    async def send(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, body: bytes) -> tuple:
+        """ Send the request over a connection and read the response, the connection is kept open if the server allows it."""
+        try:
+            headers = [
+                f"POST {self.url.path or '/'} HTTP/1.1",
+                f"Host: {self.url.netloc}",
+                "Content-Type: application/json",
+                f"Content-Length: {len(body)}",
+                "Connection: keep-alive"
+            ]
+            if self.api_key is not None:
+                headers.append(f"Authorization: Bearer {self.api_key}")
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+
+            # A closed connection reads as an empty status line
+            status_line = (await reader.readline()).split()
+            if len(status_line) < 2 or not status_line[1].isdigit():
+                raise ConnectionResetError(f"No valid status line from the server: {b' '.join(status_line)[:100]!r}")
+            status = int(status_line[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                response_headers[key.strip().lower()] = value.strip()
+
+            if response_headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    chunk = await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+                    chunks.append(chunk[:-2])
+                data = b"".join(chunks)
+            else:
+                data = await reader.readexactly(int(response_headers.get("content-length", 0)))
+        except BaseException:
+            writer.close()
+            raise
+
+        # Keep the connection open for the next request, unless the server closes it
+        if response_headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self.idle_connections.append((reader, writer))
+        return status, data
+
+    def get_performance_report(self) -> dict:
+        """
+        The number of requests (sent, retried and coalesced), the connections opened and the generation speed in tokens per second.
+        """
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "connections_opened": self.connections_opened,
+            "generated_tokens": self.generated_tokens,
+            "seconds": round(self.generation_seconds, 3),
+            "tokens_per_second": round(self.generated_tokens / self.generation_seconds, 2) if self.generation_seconds > 0 else 0.0
+        }
+
+    def close(self):
+        """ Close the connections and stop the event loop."""
+        async def close_connections():
+            for reader, writer in self.idle_connections:
+                writer.close()
+            self.idle_connections = []
+        asyncio.run_coroutine_threadsafe(close_connections(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,104 @@
+"""
+Stopping criteria to end the generation as soon as the answer is complete, instead of always generating max_new_tokens.
+"""
+
+import re
+import torch
+from transformers import StoppingCriteria
+
+# Text after the answer that shows the list is done (e.g. an explanation), anything other than another tuple
+AFTER_LIST_PATTERN = re.compile(r"[\s,]*([^\s,])")
+# An explicit verdict that the text has no fallacy, e.g. "This is not a fallacy." or "The text contains no fallacies."
+NO_FALLACY_VERDICT_PATTERN = re.compile(
+    r"\b(no|not (a|any)|without( any)?|free of|(does not|doesn't) contain (a|any)) (logical )?fallac(y|ies)\b", re.IGNORECASE
+)
+
+# The number of previous tokens the new tokens are decoded after (see AnswerCompleteCriteria.decode_new_tokens)
+DECODE_CONTEXT = 4
+
+
+def answer_complete(text: str) -> bool:
+    """
+    Whether the response contains a complete answer in the output format:
+    - an empty list, or an outer list of tuples, that is closed
+    - tuples, followed by a blank line or by text that is not another tuple
+    - no list, but an explicit "no fallacy" verdict that ends its line or sentence
+    Text before the list (e.g. reasoning) is skipped.
+    """
+    start = text.find("[")
+    if start == -1:
+        return NO_FALLACY_VERDICT_PATTERN.search(text) is not None and ("\n" in text.strip() or text.rstrip().endswith("."))
+    text = text[start:]
+
+    depth = 0
+    nested = False
+    for i, character in enumerate(text):
+        if character == "[":
+            depth += 1
+            nested = nested or depth > 1
+        elif character == "]":
+            depth -= 1
+            if depth == 0:
+                # Empty list or outer list that is closed
+                if nested or text[:i + 1].replace(" ", "") in ("[]", "[\n]"):
+                    return True
+                # A single tuple, see what follows it
+                rest = text[i + 1:]
+                if "\n\n" in rest.split("[", 1)[0]:
+                    return True
+                match = AFTER_LIST_PATTERN.match(rest)
+                if match is not None and match.group(1) != "[":
+                    return True
+    return False
+
+
+class AnswerCompleteCriteria(StoppingCriteria):
+    """
+    Stops each sequence of a batch once its generated text contains a complete answer (see answer_complete).
+
+    Parameters:
+    - tokenizer: the tokenizer to decode the generated tokens with
+    - prompt_length: int, the length of the (padded) prompts, after which the generated tokens start
+    """
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        # The sequences (batch indices) that were stopped by this criteria
+        self.stopped = set()
+        # The text generated so far for each sequence, and the number of generated tokens it was decoded from
+        self.texts = {}
+        self.offsets = {}
+
+    def decode_new_tokens(self, i: int, generated: list) -> str:
+        """
+        The text of sequence i, of which only the tokens after the last call are decoded.
+        The new tokens are decoded after a few of the previous tokens, as some tokenizers decode a token differently at the
+        start of the text (e.g. without its leading space), and are left for the next call if they end within a character.
+        """
+        text, offset = self.texts.get(i, ""), self.offsets.get(i, 0)
+        if len(generated) == offset:
+            return text
+        context = generated[max(0, offset - DECODE_CONTEXT):offset]
+        context_text = self.tokenizer.decode(context, skip_special_tokens=True)
+        new_text = self.tokenizer.decode(context + generated[offset:], skip_special_tokens=True)
+        if new_text.endswith("\ufffd"):
+            return text
+        if new_text.startswith(context_text):
+            text += new_text[len(context_text):]
+        else:
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        self.texts[i], self.offsets[i] = text, len(generated)
+        return text
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for i in range(input_ids.shape[0]):
+            # Stopped sequences are not decoded or checked again
+            if i in self.stopped:
+                is_done[i] = True
+                continue
+            text = self.decode_new_tokens(i, input_ids[i, self.prompt_length:].tolist())
+            if answer_complete(text):
+                self.stopped.add(i)
+                is_done[i] = True
+        return is_done
@@ -0,0 +1,75 @@
+"""
+Stub of an OpenAI-compatible completions server, to try ServerModel without a GPU (or a network).
+It answers every prompt with a fixed tuple after a simulated latency, and can fail a fraction of the requests.
+
+Usage: python -m models.stub_server [port] [latency in seconds] [failure rate]
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Handles the completion requests (over keep-alive connections), the settings are set on the class by serve.
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    failure_rate = 0.0
+    # The number of requests that were handled (including the failed ones)
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            StubHandler.requests += 1
+        time.sleep(self.latency)
+
+        if random.random() < self.failure_rate:
+            self.send_json(503, {"error": "overloaded"})
+            return
+
+        # The same prompt always gets the same response
+        end = int(hashlib.sha1(payload["prompt"].encode("utf-8")).hexdigest(), 16) % 500
+        text = f"[['ad hominem', 0, {end}]]"
+        self.send_json(200, {
+            "object": "text_completion",
+            "model": payload["model"],
+            "choices": [{"index": 0, "text": text, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(payload["prompt"].split()), "completion_tokens": len(text.split())}
+        })
+
+    def send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 8000, latency: float = 0.05, failure_rate: float = 0.0) -> ThreadingHTTPServer:
+    """ Start the stub server in a background thread (port 0 picks a free port, see server.server_address)."""
+    StubHandler.latency = latency
+    StubHandler.failure_rate = failure_rate
+    server = ThreadingHTTPServer(("localhost", port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    serve(port, latency, failure_rate)
+    print(f"Stub server listening on http://localhost:{port}/v1/completions")
+    threading.Event().wait()
@@ -1,9 +1,16 @@
 from data import Data
 from models.model import Model
 from prompting_techniques.prompt import Prompt
-from random import shuffle
+from random import Random
 from fallacy_extraction import LEVEL_1_CLUSTERS, LEVEL_2_CLUSTERS, LEVEL_2_TO_LEVEL_1
 from prompting_techniques.zero_shot import ZeroShot
+import hashlib
+import json
+import os
+
+# Demonstration banks that are already built, per (model name, level, seed, version), see get_demonstration_bank
+DEMONSTRATION_BANKS = {}
+
 
 class AutomaticCoT(Prompt):
     """
@@ -14,29 +21,71 @@ class AutomaticCoT(Prompt):
     - data: Data, the data object
     - model: Model, the model object
     - level: int, the level of fallacies to cluster the data into (1 or 2) (Optional, default is 2)
+    - seed: int, the seed used to choose the representative question of each cluster (Optional, default is 0)
     """
-    def __init__(self, text: str, data: Data, model: Model, level: int = 2):
+    # The demonstrations in the prompt make the model reason step by step before it answers, and the demonstrations themselves
+    # are such reasoning, both do not fit in the default budget
+    max_new_tokens = 200
+
+    def __init__(self, text: str, data: Data, model: Model, level: int = 2, seed: int = 0):
         super().__init__("Automatic-CoT", text, data, model)
         self.level = level
+        self.seed = seed
         self.clusters = LEVEL_1_CLUSTERS if self.level == 1 else LEVEL_2_CLUSTERS
         self.clustered_data = {cluster: [] for cluster in self.clusters}
 
     def get_prompt_context(self) -> str:
-        """ 
+        """
         Automatic CoT prompt context is some examples from the data with chain of thought reasoning.
         """
-        self.cluster_data()
-        self.demonstrations = self.generate_demonstrations()
+        self.demonstrations = self.get_demonstration_bank()
 
         examples = []
         for cluster, demonstrations in self.demonstrations.items():
+            # Make sure the prompt does not occur in the demonstrations (hence the spare demonstration)
+            demonstrations = [demonstration for text, demonstration in demonstrations if text != self.text]
             if not demonstrations:
                 continue
 
             example = demonstrations[0] + "\n"
             examples.append(example)
         return "\n".join(examples)
-    
+
+    def get_demonstration_bank(self) -> dict:
+        """
+        Get the demonstrations for this model, level and seed. These are only generated once and stored in
+        data/demonstrations, such that all prompts (and later runs) can reuse them. The banks are versioned by
+        everything else they depend on: the data, the checkpoint and the generation settings of the model.
+        """
+        version = hashlib.sha1(json.dumps(
+            [self.data.get_hash(), self.model.checkpoint, self.model.get_generation_settings()], sort_keys=True
+        ).encode("utf-8")).hexdigest()[:16]
+        key = (self.model.name, self.level, self.seed, version)
+        if key in DEMONSTRATION_BANKS:
+            return DEMONSTRATION_BANKS[key]
+
+        path = f"data/demonstrations/{self.model.name}_level{self.level}_seed{self.seed}_{version}.json"
+        try:
+            with open(path, "r") as f:
+                bank = json.load(f)
+        except FileNotFoundError:
+            self.cluster_data()
+            bank = self.generate_demonstrations()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Only the first process that finishes stores its bank (e.g. with several shards at once), the others use that one
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(bank, f)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                with open(path, "r") as f:
+                    bank = json.load(f)
+            os.remove(tmp_path)
+
+        DEMONSTRATION_BANKS[key] = bank
+        return bank
+
     def cluster_data(self) -> dict:
         """
         Cluster the questions into clusters (type of fallacies).
@@ -55,35 +104,35 @@ class AutomaticCoT(Prompt):
                     continue
                 self.clustered_data[cluster].append((text, label))
 
-    def generate_demonstrations(self) -> str:
+    def generate_demonstrations(self) -> dict:
         """
         For all clusters choose a random representative question and generate a demonstration.
         This is done by Zero-Shot CoT; asking the model to think step by step.
+
+        A spare question is chosen as well, for when the representative question is the prompt itself.
+        Returns a list of (question, demonstration) pairs per cluster.
         """
-        demonstrations = {cluster: [] for cluster in self.clusters}
+        random = Random(self.seed)
+        questions = []
         for cluster, data in self.clustered_data.items():
-            if not data:
-                continue
-            
-            # Make sure the prompt does not occur in the demonstrations
-            # And avoid infinite loop
-            text = self.text
-            iteration = 0
-            while text == self.text and iteration < 10:
-                shuffle(data)
-                text, label = data[0]
-                iteration += 1
-            
-            # If we did not find a suitable question, skip the cluster
-            if iteration != 10:
-                # We use a simple modification of Zero-Shot for Zero-Shot CoT
-                zero_shot = ZeroShot(text, self.data, self.model)
-                zero_shot.additional_info = "Think step by step."
-
-                # Get the model response
-                response = self.model.generate_response(str(zero_shot))
-                
-                # Add question + response to the demonstrations
-                demonstrations[cluster].append(f"Question: {text}\nResponse: {response}")
+            # Choose (at most) two different questions, the representative and the spare
+            texts = sorted({text for text, label in data})
+            random.shuffle(texts)
+            questions += [(cluster, text) for text in texts[:2]]
+
+        # We use a simple modification of Zero-Shot for Zero-Shot CoT
+        prompts = []
+        for cluster, text in questions:
+            zero_shot = ZeroShot(text, self.data, self.model)
+            zero_shot.additional_info = "Think step by step."
+            prompts.append(str(zero_shot))
+
+        # Get the model responses
+        responses = self.generate_responses(prompts)
+
+        # Add question + response to the demonstrations
+        demonstrations = {cluster: [] for cluster in self.clusters}
+        for (cluster, text), response in zip(questions, responses):
+            demonstrations[cluster].append((text, f"Question: {text}\nResponse: {response}"))
 
         return demonstrations
@@ -1,7 +1,68 @@
 from data import Data
-from prompting_techniques.prompt import Prompt
-from random import shuffle
+from prompting_techniques.prompt import Prompt, tokenize
 from models.model import Model
+from typing import List
+from weakref import WeakKeyDictionary
+import numpy as np
+import random
+
+# Similarity indices that are already built, per data object
+SIMILARITY_INDICES = WeakKeyDictionary()
+
+
+class SimilarityIndex:
+    """
+    TF-IDF index over the texts of the data, to find the most similar texts by cosine similarity.
+    The neighbours of each text are cached, such that later prompts (e.g. for other models) reuse them.
+
+    parameters:
+    - data: Data, the data object
+    """
+    def __init__(self, data: Data):
+        self.texts = [text for text, labels in data]
+
+        # Term frequencies of the texts
+        self.vocabulary = {}
+        rows, columns = [], []
+        for i, text in enumerate(self.texts):
+            for token in tokenize(text):
+                rows.append(i)
+                columns.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+        counts = np.zeros((len(self.texts), len(self.vocabulary)), dtype=np.float32)
+        np.add.at(counts, (rows, columns), 1)
+
+        # Weigh by the inverse document frequency and normalise, such that the dot product is the cosine similarity
+        self.idf = np.log((1 + len(self.texts)) / (1 + np.count_nonzero(counts, axis=0))) + 1
+        self.matrix = self.normalize(counts * self.idf)
+        self.neighbours = {}
+
+    def vectorize(self, text: str) -> np.ndarray:
+        """ TF-IDF vector of a text (tokens that are not in the data are ignored)."""
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for token in tokenize(text):
+            if token in self.vocabulary:
+                vector[self.vocabulary[token]] += 1
+        return self.normalize(vector * self.idf)
+
+    def normalize(self, matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def nearest(self, text: str, k: int) -> List[int]:
+        """ The indices of the k texts most similar to the given text, excluding the text itself."""
+        if (text, k) not in self.neighbours:
+            scores = self.matrix @ self.vectorize(text)
+            scores[[i for i, other in enumerate(self.texts) if other == text]] = -np.inf
+            order = np.argsort(-scores, kind="stable")[:k]
+            self.neighbours[(text, k)] = [int(i) for i in order if scores[i] != -np.inf]
+        return self.neighbours[(text, k)]
+
+
+def get_similarity_index(data: Data) -> SimilarityIndex:
+    """ Get the similarity index of the data, which is only built once per data object."""
+    if data not in SIMILARITY_INDICES:
+        SIMILARITY_INDICES[data] = SimilarityIndex(data)
+    return SIMILARITY_INDICES[data]
 
 
 class FewShot(Prompt):
@@ -13,19 +74,29 @@ class FewShot(Prompt):
     - data: Data, the data object
     - model: Model, the model object
     - num_examples: int, the number of examples to show (Optional, default is 5)
+    - similar: bool, whether to show the examples most similar to the text instead of random ones (Optional, default is False)
     """
-    def __init__(self, text: str, data: Data, model: Model, num_examples: int = 5):
+    def __init__(self, text: str, data: Data, model: Model, num_examples: int = 5, similar: bool = False):
         super().__init__("Few-Shot", text, data, model)
         self.num_examples = num_examples
+        self.similar = similar
 
     def get_prompt_context(self) -> str:
         """ Few-shot prompt context is some examples from the data."""
         examples = []
-        shuffle(self.data.data)
-        for i in range(self.num_examples):
+        for i in self.select_examples():
             prompt, labels = self.data[i]
-            if prompt != self.text: # Do not include the prompt itself if it is sampled
-                output = [f"{labels.name} ({labels.start}, {labels.end})" for labels in labels]
-                labeled_prompt = f"text: {prompt}\n output: {output}"
-                examples.append(labeled_prompt)
+            output = [f"{labels.name} ({labels.start}, {labels.end})" for labels in labels]
+            labeled_prompt = f"text: {prompt}\n output: {output}"
+            examples.append(labeled_prompt)
         return "\n".join(examples)
+
+    def select_examples(self) -> List[int]:
+        """ Select the indices of the examples, without the prompt itself (and without modifying the data)."""
+        if self.similar:
+            return get_similarity_index(self.data).nearest(self.text, self.num_examples)
+
+        # Sample one extra, in case the prompt itself is sampled
+        indices = random.sample(range(len(self.data)), min(self.num_examples + 1, len(self.data)))
+        indices = [i for i in indices if self.data[i][0] != self.text]
+        return indices[:self.num_examples]
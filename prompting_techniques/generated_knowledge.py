@@ -1,9 +1,73 @@
-from prompting_techniques.prompt import Prompt
+from prompting_techniques.prompt import Prompt, tokenize
 from models.model import Model
+from collections import Counter, defaultdict
+import heapq
 import json
-from random import shuffle
+import math
 import random
-from typing import List
+from typing import List, Tuple
+
+# Knowledge stores that are already loaded, per path
+KNOWLEDGE_STORES = {}
+
+
+class KnowledgeStore:
+    """
+    The (query, knowledges) pairs of the Generated Knowledge Prompting paper dataset, loaded in memory once.
+
+    parameters:
+    - path: str, the path to the knowledge dataset
+    """
+    def __init__(self, path: str):
+        with open(path, "r") as f:
+            data = json.load(f)
+        self.queries = [entry["query"] for entry in data]
+        self.knowledges = [entry["knowledges"] for entry in data]
+
+        # Inverted index (token -> query indices) with the idf of each token, only built when needed
+        self.index = None
+        self.idf = None
+
+    def __len__(self):
+        return len(self.queries)
+
+    def sample(self, k: int, rng=random) -> List[Tuple[str, str]]:
+        """ Sample k random queries (without replacement), each with one of its knowledges."""
+        indices = rng.sample(range(len(self.queries)), k)
+        return [(self.queries[i], rng.choice(self.knowledges[i])) for i in indices]
+
+    def most_similar(self, text: str, k: int, rng=random) -> List[Tuple[str, str]]:
+        """ Get the k queries that are lexically most similar to the text (idf weighted token overlap), each with one of its knowledges."""
+        if self.index is None:
+            self.build_index()
+
+        scores = Counter()
+        for token in set(tokenize(text)):
+            for i in self.index.get(token, []):
+                scores[i] += self.idf[token]
+        indices = heapq.nlargest(k, scores, key=lambda i: (scores[i], -i))
+
+        # Fill up with random queries if too few queries share a token with the text
+        if len(indices) < k:
+            remaining = [i for i in range(len(self.queries)) if i not in scores]
+            indices += rng.sample(remaining, k - len(indices))
+        return [(self.queries[i], rng.choice(self.knowledges[i])) for i in indices]
+
+    def build_index(self):
+        """ Build the inverted index over the tokens of the queries."""
+        self.index = defaultdict(list)
+        for i, query in enumerate(self.queries):
+            for token in set(tokenize(query)):
+                self.index[token].append(i)
+        self.idf = {token: math.log(len(self.queries) / len(indices)) for token, indices in self.index.items()}
+
+
+def get_knowledge_store(path: str = "data/knowledge_gpt3.dev.csqa.json") -> KnowledgeStore:
+    """ Get the knowledge store of the given path, which is only loaded once."""
+    if path not in KNOWLEDGE_STORES:
+        KNOWLEDGE_STORES[path] = KnowledgeStore(path)
+    return KNOWLEDGE_STORES[path]
+
 
 class GeneratedKnowledge(Prompt):
     """
@@ -13,9 +77,13 @@ class GeneratedKnowledge(Prompt):
     - text: str, the text of the prompt
     - data: Data, the data object
     - model: Model, the model object
+    - seed: int, the seed used to sample the few-shot examples (Optional, default is None, which is not seeded)
+    - similar: bool, whether to use the few-shot examples that are most similar to the text instead of random ones (Optional, default is False)
     """
-    def __init__(self, text: str, data, model: Model):
+    def __init__(self, text: str, data, model: Model, seed: int = None, similar: bool = False):
         super().__init__("Generated-Knowledge", text, data, model)
+        self.seed = seed
+        self.similar = similar
 
     def get_prompt_context(self) -> str:
         """ Generated knowledge prompt context"""
@@ -23,22 +91,25 @@ class GeneratedKnowledge(Prompt):
         context = f"input: {self.text}\n knowledge: {self.knowledge}"
         return context
 
-    def retrieve_few_shot_examples(self):
+    def retrieve_few_shot_examples(self, num_examples: int = 5):
         """Retrieve few-shot examples used as context for new knowledge generation."""
         # Get the data from the Generated Knowledge Prompting paper dataset
-        path = "data/knowledge_gpt3.dev.csqa.json"
-        with open(path, "r") as f:
-            data = json.load(f)
+        knowledge_store = get_knowledge_store()
+
+        # Seed per text, such that every text gets its own (reproducible) examples
+        rng = random if self.seed is None else random.Random(f"{self.seed}:{self.text}")
 
         # Get the few-shot examples
-        shuffle(data)
+        if self.similar:
+            pairs = knowledge_store.most_similar(self.text, num_examples, rng)
+        else:
+            pairs = knowledge_store.sample(num_examples, rng)
+
         examples = []
-        for i in range(5):
-            input = data[i]["query"]
-            knowledge = random.choice(data[i]["knowledges"])
+        for input, knowledge in pairs:
             examples.append(f"input: {input}\n knowledge: {knowledge}\n")
         return examples
-    
+
     def generate_knowledge(self, few_shot_examples: List[str]):
         """
         Use the few-shot examples to generate new knowledge.
@@ -49,6 +120,6 @@ class GeneratedKnowledge(Prompt):
 
         # Generate new knowledge
         prompt = "\n".join(few_shot_examples)
-        response = self.model.generate_response(prompt)
+        response = self.generate_response(prompt)
 
         self.knowledge = response
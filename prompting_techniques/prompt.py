@@ -1,34 +1,13 @@
 from abc import abstractmethod
+from contextlib import nullcontext
+from typing import List
 from data import Data
 from models.model import Model
+import re
 
-
-class Prompt:
-    """
-    This is the prompt superclass.
-    It has a standard text format, which is a string. And had subclasses, that implement
-    separate prompting techniques.
-
-    Parameters:
-    - name: str, the name of the prompting technique
-    - text: str, the text of the prompt
-    - data: Data, the data object
-    - model: Model, the model object
-    """
-    def __init__(self, name, text: str, data: Data, model: Model = None):
-        self.name = name
-        self.text = text
-        self.data = data
-        self.model = model
-        self.additional_info = ""
-
-    def __repr__(self) -> str:
-        return self.get_standard_format(self.text)
-    
-    def get_standard_format(self, text: str) -> str:
-        """ Standard format retrieved from the MAFALDA paper."""
-
-        standard_format = f"""
+# The standard format (retrieved from the MAFALDA paper) is split into the parts that are the same for every prompt,
+# such that models can cache these parts (see Prompt.get_prefix).
+DEFINITIONS = """
 Definitions:
 • An argument consists of an assertion called
 the conclusion and one or more assertions
@@ -37,8 +16,9 @@ Premises or conclusions can be implicit in an
 argument.
 • A fallacious argument is an argument where
 the premises do not entail the conclusion.
-Text: "{self.get_prompt_context()}"
-Based on the above text, determine whether the
+"""
+
+FALLACY_TYPES = """Based on the above text, determine whether the
 following sentence is part of a fallacious argument
 or not. If it is, indicate the type(s) of fallacy without providing explanations. The potential types of
 fallacy include:
@@ -70,18 +50,111 @@ fallacy include:
 • fallacy of relevance 
 • intentional
 • appeal to emotion
-Sentence: "{text}"
+"""
 
+INSTRUCTIONS = """
 Instructions:
 The output format should always adhere to the following structure:
 [fallacy_type, start, end] for each fallacy found in the text. Where the start and end are the character indices of the span of the fallacy in the text and fallacy_type is one of the types listed above. If no fallacy is found, the output should be an empty list.
 
+"""
+
+
+def tokenize(text: str) -> List[str]:
+    """ Simple lowercase word tokenization (to compare texts by their words, e.g. when selecting similar examples)."""
+    return re.findall(r"\w+", text.lower())
+
+
+class Prompt:
+    """
+    This is the prompt superclass.
+    It has a standard text format, which is a string. And had subclasses, that implement
+    separate prompting techniques.
+
+    Parameters:
+    - name: str, the name of the prompting technique
+    - text: str, the text of the prompt
+    - data: Data, the data object
+    - model: Model, the model object
+    """
+    # The token budget of the responses while this technique runs, the same as the default of the models. It also applies to
+    # the model calls that build the prompt (e.g. the generated knowledge), only the final answers are stopped earlier
+    max_new_tokens = 50
+
+    def __init__(self, name, text: str, data: Data, model: Model = None):
+        self.name = name
+        self.text = text
+        self.data = data
+        self.model = model
+        self.additional_info = ""
+        # Put the parts that are the same for every prompt first, such that a larger part can be cached by the model
+        self.invariant_first = False
+
+        # The context and the final string are only computed once (see render)
+        self.context = None
+        self.rendered = None
+        # The number of model calls that were needed to build this prompt
+        self.model_calls = 0
+        # Lock around the model calls, if the model is also used by another thread (see Experiment.run_pipelined)
+        self.model_lock = None
+
+    def __repr__(self) -> str:
+        return self.render()
+
+    def render(self) -> str:
+        """
+        Returns the final prompt string. This is only computed once (unless the additional info or layout change afterwards),
+        such that printing, logging and generating all use exactly the same prompt.
+        """
+        key = (self.additional_info, self.invariant_first)
+        if self.rendered is None or self.rendered[0] != key:
+            self.rendered = (key, self.get_standard_format(self.text))
+        return self.rendered[1]
+
+    def get_context(self) -> str:
+        """ Returns the context of the prompt, which is only computed once (as it may require model calls)."""
+        if self.context is None:
+            self.context = self.get_prompt_context()
+        return self.context
+
+    def generate_response(self, prompt: str) -> str:
+        """ Generate a response with the model while building this prompt (counted in model_calls)."""
+        self.model_calls += 1
+        with self.model_lock or nullcontext():
+            return self.model.generate_response(prompt)
+
+    def generate_responses(self, prompts: List[str]) -> List[str]:
+        """ Generate responses with the model while building this prompt (counted in model_calls)."""
+        self.model_calls += len(prompts)
+        with self.model_lock or nullcontext():
+            return self.model.generate_responses(prompts)
+
+    def get_standard_format(self, text: str) -> str:
+        """ Standard format retrieved from the MAFALDA paper."""
+        if self.invariant_first:
+            standard_format = self.get_prefix() + f"""Text: "{self.get_context()}"
+Sentence: "{text}"
+
 {self.additional_info}
 
 Output:
-""" 
+"""
+        else:
+            standard_format = self.get_prefix() + f"""Text: "{self.get_context()}"
+{FALLACY_TYPES}Sentence: "{text}"
+{INSTRUCTIONS}{self.additional_info}
+
+Output:
+"""
         return standard_format
-        
+
+    def get_prefix(self) -> str:
+        """ The start of the standard format, which is the same for every prompt (and can thus be cached by the model)."""
+        if self.invariant_first:
+            fallacy_types = FALLACY_TYPES.replace("the above text", "the text below").replace("following sentence", "sentence below")
+            return DEFINITIONS + fallacy_types + INSTRUCTIONS
+        return DEFINITIONS
+
     @abstractmethod
     def get_prompt_context(self) -> str:
         """ To be implemented by subclasses. Returns the context of the prompt specific to type of prompting technique. """
@@ -0,0 +1,88 @@
+"""
+Buffered writer for the response files, such that an experiment does not reopen the output file for every response.
+"""
+from typing import Callable
+import gzip
+import json
+import os
+import shutil
+import time
+
+
+class ResponseWriter:
+    """
+    Writes the records of one response file through a single handle. The records are buffered and flushed (with an fsync)
+    every flush_every records or flush_interval seconds (checked whenever a record is written).
+    While writing, the records go to a partial file next to the output, which replaces the output atomically once
+    the writer is closed. A crashed run thus leaves the previous output intact, and the partial file to resume from.
+
+    parameters:
+    - path: str, the path of the response file
+    - flush_every: int, the number of buffered records after which they are flushed (Optional, default is 64)
+    - flush_interval: float, the number of seconds after which the buffered records are flushed (Optional, default is 5.0)
+    - compress: bool, whether to also write a gzip compressed copy (path + ".gz") on close (Optional, default is False)
+    - resume: bool, whether to continue the partial (or otherwise the complete) file instead of starting over (Optional, default is False)
+    - on_flush: Callable, called after every flush with the number of records flushed so far (Optional)
+    """
+    def __init__(self, path: str, flush_every: int = 64, flush_interval: float = 5.0, compress: bool = False,
+                 resume: bool = False, on_flush: Callable[[int], None] = None):
+        self.path = path
+        self.partial_path = path + ".partial"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.on_flush = on_flush
+
+        if resume:
+            # Continue the complete file of a previous run if there is no partial file
+            if not os.path.exists(self.partial_path) and os.path.exists(path):
+                os.replace(path, self.partial_path)
+        elif os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+        # The handle is only opened on the first flush, such that the partial file can still be truncated before that
+        self.handle = None
+        self.buffer = []
+        self.flushed = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, record: dict):
+        """ Buffer a record, and flush the buffer if it is full or old enough."""
+        self.buffer.append(json.dumps(record) + "\n")
+        if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered records to the partial file, and make sure they are on disk."""
+        if self.handle is None:
+            self.handle = open(self.partial_path, "a", encoding="utf-8")
+        if self.buffer:
+            self.handle.write("".join(self.buffer))
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+            self.flushed += len(self.buffer)
+            self.buffer = []
+            if self.on_flush is not None:
+                self.on_flush(self.flushed)
+        self.last_flush = time.monotonic()
+
+    def close(self, complete: bool = True):
+        """
+        Flush the remaining records and close the handle. If the run is complete, the partial file replaces the output
+        (and the compressed copy is written), otherwise it is kept to resume from.
+        """
+        self.flush()
+        self.handle.close()
+        self.handle = None
+        if not complete:
+            return
+
+        if self.compress:
+            # Fixed mtime, such that the same responses always compress to the same bytes
+            with open(self.partial_path, "rb") as source, open(self.path + ".gz.tmp", "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as target:
+                    shutil.copyfileobj(source, target)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(self.path + ".gz.tmp", self.path + ".gz")
+        os.replace(self.partial_path, self.path)
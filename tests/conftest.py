@@ -0,0 +1,40 @@
+"""
+Fixtures shared by the tests: a tiny (randomly initialised) Llama model with a byte-level BPE tokenizer, saved as a
+HuggingFace checkpoint, such that the HuggingFace code paths run on the CPU without downloading anything.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def tiny_checkpoint(tmp_path_factory):
+    """ The directory of the tiny checkpoint."""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    tokenizers = pytest.importorskip("tokenizers")
+    from fallacy_extraction import LEVEL_2_CLUSTERS
+
+    # The tokenizer is trained on the labels and the output format, such that it has multi-character tokens for them
+    corpus = [f"[{label}, 12, 40], ['{label}', 3, 9]" for label in LEVEL_2_CLUSTERS] + ["Text: the sentence is a fallacy. []"]
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.BPE())
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = tokenizers.decoders.ByteLevel()
+    trainer = tokenizers.trainers.BpeTrainer(vocab_size=400, special_tokens=["</s>"],
+                                             initial_alphabet=tokenizers.pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+
+    path = str(tmp_path_factory.mktemp("tiny_checkpoint"))
+    fast_tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="</s>")
+    fast_tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=len(fast_tokenizer), hidden_size=64, intermediate_size=128,
+                                      num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4,
+                                      eos_token_id=fast_tokenizer.eos_token_id, pad_token_id=fast_tokenizer.eos_token_id)
+    transformers.LlamaForCausalLM(config).save_pretrained(path)
+    return path
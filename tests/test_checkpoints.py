@@ -0,0 +1,83 @@
+"""
+Tests of the local model cache: preparing a checkpoint once, and loading the models from it.
+"""
+
+import os
+import sys
+import threading
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models import checkpoints
+from models.checkpoints import find_cached_checkpoint, get_cache_path, prepare_checkpoint
+
+
+@pytest.fixture
+def conversions(monkeypatch):
+    """ Counts the number of times a model is loaded to be converted."""
+    calls = []
+    from_pretrained = checkpoints.AutoModelForCausalLM.from_pretrained
+
+    def counting_from_pretrained(*args, **kwargs):
+        calls.append(args[0])
+        return from_pretrained(*args, **kwargs)
+    monkeypatch.setattr(checkpoints.AutoModelForCausalLM, "from_pretrained", counting_from_pretrained)
+    return calls
+
+
+def test_prepare_once(tiny_checkpoint, tmp_path, conversions):
+    cache_dir = str(tmp_path / "model_cache")
+    assert find_cached_checkpoint(tiny_checkpoint, torch.float32, cache_dir) is None
+
+    path = prepare_checkpoint(tiny_checkpoint, torch.float32, cache_dir)
+    assert path == get_cache_path(tiny_checkpoint, torch.float32, cache_dir)
+    assert find_cached_checkpoint(tiny_checkpoint, torch.float32, cache_dir) == path
+    assert os.path.exists(os.path.join(path, "model.safetensors"))
+    assert os.path.exists(os.path.join(path, "tokenizer.json"))
+    # Nothing but the checkpoint (and its lock) is left in the cache
+    assert sorted(os.listdir(cache_dir)) == sorted([os.path.basename(path), os.path.basename(path) + ".lock"])
+
+    assert prepare_checkpoint(tiny_checkpoint, torch.float32, cache_dir) == path
+    assert len(conversions) == 1
+    # Every dtype is stored apart
+    assert prepare_checkpoint(tiny_checkpoint, torch.bfloat16, cache_dir) != path
+    assert len(conversions) == 2
+
+
+def test_concurrent_prepare_converts_once(tiny_checkpoint, tmp_path, conversions):
+    cache_dir = str(tmp_path / "model_cache")
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(prepare_checkpoint(tiny_checkpoint, torch.float32, cache_dir)))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(paths)) == 1 and len(paths) == 3
+    assert len(conversions) == 1
+
+
+def test_load_from_cache(tiny_checkpoint, tmp_path, monkeypatch):
+    from models.huggingface import HuggingFaceModel
+    monkeypatch.chdir(tmp_path)
+    prompts = ["Text: the sentence is a fallacy.", "the"]
+
+    model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cpu")
+    assert model.loaded_from == tiny_checkpoint
+    model.generation_kwargs = {"max_new_tokens": 8, "do_sample": False}
+    expected = model.generate_responses(prompts)
+
+    path = prepare_checkpoint(tiny_checkpoint, torch.float32)
+    model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cpu")
+    assert model.loaded_from == path
+    model.generation_kwargs = {"max_new_tokens": 8, "do_sample": False}
+    assert model.generate_responses(prompts) == expected
+
+    report = model.get_performance_report()
+    assert report["loaded_from"] == path
+    assert {"tokenizer", "weights", "placement"} <= set(report["load_seconds"])
@@ -0,0 +1,85 @@
+"""
+Tests of the constrained decoding: the grammar accepts the output format of the prompt, and the constrained output of a
+(tiny, random) model parses as structured output.
+"""
+
+import os
+import random
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from fallacy_extraction import parse_structured
+from models.constrained import DONE, TupleGrammar
+
+
+def accepts(grammar, text):
+    state = ("start",)
+    for character in text:
+        state = grammar.advance(state, character)
+        if state is None:
+            return False
+    return state == DONE or state == ("next", False)
+
+
+@pytest.fixture(scope="module")
+def grammar(tiny_checkpoint):
+    from transformers import AutoTokenizer
+    return TupleGrammar(AutoTokenizer.from_pretrained(tiny_checkpoint))
+
+
+@pytest.mark.parametrize("text", [
+    "[]",
+    "[ad hominem, 12, 40]",
+    "[ad hominem, 12, 40], [straw man, 3, 9]",
+    " [appeal to (false) authority, 1, 2]",
+    "[['ad hominem', 12, 40], ['straw man', 3, 9]]",
+    "['appeal to emotion', 1, 2], [appeal to positive emotion, 3, 4]",
+])
+def test_grammar_accepts(grammar, text):
+    assert accepts(grammar, text)
+
+
+@pytest.mark.parametrize("text", [
+    "[unknown, 1, 2]",
+    "[ad hominem 1, 2]",
+    "['ad hominem, 1, 2]",
+    "[[ad hominem, 1, 2]",
+    "[ad hominem, 1, 2]]",
+    "[ad hominem, , 2]",
+])
+def test_grammar_rejects(grammar, text):
+    assert not accepts(grammar, text)
+
+
+def test_random_walks_parse(grammar):
+    """ Every walk over the allowed tokens of the grammar is an output that parses as structured output."""
+    rng = random.Random(0)
+    for _ in range(200):
+        state, text = ("start",), ""
+        while True:
+            token_id = rng.choice(grammar.allowed_tokens(state))
+            if token_id == grammar.eos_token_id:
+                break
+            state = grammar.advance_token(state, token_id)
+            text += grammar.token_texts[token_id]
+        assert parse_structured(text) is not None, text
+
+
+def test_constrained_generation_parses(tiny_checkpoint):
+    """ The constrained final answers of the tiny model parse, the other responses are not constrained."""
+    import torch
+    from models.huggingface import HuggingFaceModel
+    torch.manual_seed(0)
+    model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, constrained_decoding=True, early_stopping=False, device="cpu")
+    # Long enough to complete a tuple, the labels are at most 27 characters
+    model.generation_kwargs = {"max_new_tokens": 80, "do_sample": True}
+    prompts = ["Text: the sentence is a fallacy.", "Output:", "[ad hominem, 1, 2], ["]
+
+    for response in model.generate_responses(prompts, batch_size=2, final_answer=True):
+        assert parse_structured(response) is not None, response
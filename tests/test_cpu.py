@@ -0,0 +1,53 @@
+"""
+Tests of running the HuggingFace models on the CPU, optionally with the linear layers quantized to int8.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.huggingface import HuggingFaceModel
+
+PROMPTS = ["Text: the sentence is a fallacy.", "[ad hominem, 12, 40]", "the"]
+
+
+def test_quantized_cpu_run(tiny_checkpoint):
+    threads = torch.get_num_threads()
+    try:
+        model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cpu", quantize=True, num_threads=1)
+    finally:
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(threads)
+    assert num_threads == 1
+    model.generation_kwargs = {"max_new_tokens": 8, "do_sample": False}
+
+    # The linear layers are replaced by their dynamically quantized version
+    assert not any(type(module) is torch.nn.Linear for module in model.model.modules())
+    responses = model.generate_responses(PROMPTS, batch_size=2)
+    assert len(responses) == len(PROMPTS)
+    assert all(stats["generated_tokens"] <= 8 for stats in model.latest_stats)
+
+    # The quantized responses are cached apart from the others
+    assert model.get_generation_settings()["quantize"] is True
+    report = model.get_performance_report()
+    assert report["device"] == "cpu"
+    assert report["quantized"] is True
+    assert report["generated_tokens"] == sum(stats["generated_tokens"] for stats in model.latest_stats)
+    assert {"tokenizer", "weights", "quantize"} <= set(report["load_seconds"])
+
+
+def test_unquantized_settings(tiny_checkpoint):
+    model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cpu")
+    assert "quantize" not in model.get_generation_settings()
+    assert model.get_performance_report()["quantized"] is False
+
+
+def test_quantize_only_on_cpu(tiny_checkpoint):
+    with pytest.raises(ValueError, match="only supported on the CPU"):
+        HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cuda:0", quantize=True)
@@ -0,0 +1,65 @@
+"""
+Tests of the data class: single items read from the (possibly compressed) file, the columns, and the parsed lines.
+"""
+
+import gzip
+import json
+import os
+import pickle
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import Data, Label
+
+GOLD_PATH = os.path.join(ROOT, "data/gold_standard_dataset.jsonl")
+
+
+def read_lines():
+    with open(GOLD_PATH, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def as_tuples(item):
+    text, labels = item
+    return text, [(label.start, label.end, label.name) for label in labels]
+
+
+def test_items_before_and_after_columns():
+    lines = read_lines()
+    data = Data(GOLD_PATH)
+    expected = [(line["text"], [tuple(label) for label in line["labels"]]) for line in lines]
+    # Read from the file, in any order, before the columns are built
+    assert [as_tuples(data[i]) for i in reversed(range(len(data)))] == expected[::-1]
+    assert data.texts is None
+    assert [as_tuples(item) for item in data] == expected
+    assert data.texts is not None
+    assert as_tuples(data[-1]) == expected[-1]
+    assert isinstance(data[0][1][0], Label)
+
+
+def test_compressed_file(tmp_path):
+    path = str(tmp_path / "gold.jsonl")
+    with open(GOLD_PATH, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+        shutil.copyfileobj(source, target)
+    data = Data(path)
+    assert data.data_path == path + ".gz"
+    plain = Data(GOLD_PATH)
+    assert [as_tuples(data[i]) for i in reversed(range(len(data)))] == [as_tuples(plain[i]) for i in reversed(range(len(plain)))]
+    assert data.get_field(3, "comments") == plain.get_field(3, "comments")
+
+
+def test_parsed_lines():
+    data = Data(GOLD_PATH)
+    assert data.data == read_lines()
+    assert data.data is data.data
+
+
+def test_pickle():
+    data = Data(GOLD_PATH)
+    data[0]
+    copy = pickle.loads(pickle.dumps(data))
+    assert as_tuples(copy[5]) == as_tuples(data[5])
+    assert copy.get_field(5, "sentences_with_labels") == data.get_field(5, "sentences_with_labels")
@@ -0,0 +1,69 @@
+"""
+Tests of the parser of the structured output format ([fallacy_type, start, end] tuples) and its keyword fallback.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fallacy_extraction import extract_fallacies_with_path, normalize_fallacy, parse_structured
+
+
+@pytest.mark.parametrize("response, fallacies", [
+    # Unquoted, as the prompt asks for, and quoted names (single or double quotes)
+    ("[ad hominem, 3, 4]", [[3, 4, "ad hominem"]]),
+    ("['ad hominem', 3, 4]", [[3, 4, "ad hominem"]]),
+    ('["straw man", 3, 4]', [[3, 4, "straw man"]]),
+    # Several tuples, separated or in an outer list, and names with underscores
+    ("[ad hominem, 1, 5], [appeal_to_nature, 7, 9]", [[1, 5, "ad hominem"], [7, 9, "appeal to nature"]]),
+    ("[['ad hominem', 1, 5], ['straw man', 7, 9]]", [[1, 5, "ad hominem"], [7, 9, "straw man"]]),
+    ("[\n  [ad hominem, 1, 5]\n]", [[1, 5, "ad hominem"]]),
+    # Several tuples flattened into one list
+    ("[ad hominem, 10, 20, straw man, 30, 40]", [[10, 20, "ad hominem"], [30, 40, "straw man"]]),
+    # Text before the list (e.g. reasoning), and an explanation after it
+    ("Output: [ad hominem, 3, 4]", [[3, 4, "ad hominem"]]),
+    ("Step [1]: read the text.\nAnswer: [straw man, 1, 2]", [[1, 2, "straw man"]]),
+    ("[false analogy, 118, 265]\n\nExplanation: the [ad hominem, 1, 2] is not it", [[118, 265, "false analogy"]]),
+    # Tuples cut off at the end of the response, only kept if the name is complete
+    ("[appeal_to_nature, 112, 132], [appeal_to_nat", [[112, 132, "appeal to nature"]]),
+    ("[hasty generalization, 1, 72], [ad hominem, 5, ", [[1, 72, "hasty generalization"], [5, -1, "ad hominem"]]),
+    ("[hasty generalization, 1, 72], [ad hominem, ", [[1, 72, "hasty generalization"], [-1, -1, "ad hominem"]]),
+    # An empty list is the "nothing" verdict
+    ("[]", [[0, 0, "Nothing"]]),
+    ("[]\n\n\n", [[0, 0, "Nothing"]]),
+])
+def test_structured(response, fallacies):
+    assert parse_structured(response) == fallacies
+    assert extract_fallacies_with_path(response) == (fallacies, "structured")
+
+
+@pytest.mark.parametrize("response", [
+    # Not a fallacy type
+    "[1, 2, 3]",
+    "[foo bar, 1, 2]",
+    # One unknown type makes the whole list fall back to the keywords, not only the tuples after it
+    "[ad hominem, 0, 114], [appeal to popularity, 11, 31], [straw man, 32, 42]",
+    # No list at all
+    "This is an ad hominem fallacy (23, 12).",
+])
+def test_not_structured(response):
+    assert parse_structured(response) is None
+    fallacies, path = extract_fallacies_with_path(response)
+    assert path != "structured"
+
+
+def test_keyword_fallback():
+    fallacies, path = extract_fallacies_with_path("[ad hominem, 0, 114], [appeal to popularity, 11, 31]")
+    assert path == "keywords"
+    assert [0, 114, "ad hominem"] in fallacies
+
+
+def test_normalize_fallacy():
+    assert normalize_fallacy("Ad_Hominem") == "ad hominem"
+    assert normalize_fallacy("strawman") == "straw man"
+    assert normalize_fallacy("non-fallacious") == "nothing"
+    assert normalize_fallacy("1") is None
+    assert normalize_fallacy("appeal to popularity") is None
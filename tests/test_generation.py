@@ -0,0 +1,53 @@
+"""
+Tests of the batched generation of the HuggingFace models, on a tiny (random) model on the CPU.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+PROMPTS = [
+    "Text: the sentence is a fallacy.",
+    "[ad hominem, 12, 40]",
+    "Text: no",
+    "Output: [straw man, 3, 9], [false analogy, 1",
+    "the",
+]
+
+
+@pytest.fixture(scope="module")
+def model(tiny_checkpoint):
+    from models.huggingface import HuggingFaceModel
+    model = HuggingFaceModel(name="tiny", model=tiny_checkpoint, device="cpu")
+    model.generation_kwargs = {"max_new_tokens": 12, "do_sample": False}
+    return model
+
+
+def test_batched_matches_single(model):
+    """ Greedy responses do not depend on the batch size, despite the (left) padding of the shorter prompts."""
+    single = [model.generate_responses([prompt], batch_size=1)[0] for prompt in PROMPTS]
+    assert model.generate_responses(PROMPTS, batch_size=3) == single
+    assert model.generate_responses(PROMPTS, batch_size=len(PROMPTS)) == single
+    assert len(model.latest_stats) == len(PROMPTS)
+    assert all(stats["stop_reason"] in ("eos", "max_new_tokens") for stats in model.latest_stats)
+
+
+def test_prefix_caching_matches(model):
+    """ Reusing the key/values of a shared prefix gives the same responses as prefilling the whole prompts."""
+    prefix = "Text: the sentence is"
+    prompts = [prefix + suffix for suffix in (" a fallacy.", " not", " [ad hominem, 1, 2]")]
+    model.prefix = None
+    expected = model.generate_responses(prompts, batch_size=3)
+
+    model.cache_prefix(prefix)
+    try:
+        assert model.generate_responses(prompts, batch_size=3) == expected
+        assert model.generate_responses(prompts, batch_size=2) == expected
+    finally:
+        model.prefix = None
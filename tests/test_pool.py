@@ -0,0 +1,77 @@
+"""
+Tests of the pool of model replicas, which run in spawned processes.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from models.model import Model
+from models.pool import ModelPool, parse_replicas
+from models.test import RandomModel
+
+
+class EchoModel(Model):
+    """ Responds with the prompt and the settings it was generated with, in the process of its replica."""
+    def __init__(self, fail: bool = False):
+        if fail:
+            raise ValueError("failed to load")
+        super().__init__("EchoModel")
+        self.prefix = None
+
+    def cache_prefix(self, prefix: str):
+        self.prefix = prefix
+
+    def generate_response(self, prompt: str) -> str:
+        return f"{prompt}|{self.prefix}|{self.generation_kwargs.get('max_new_tokens')}|{os.getpid()}"
+
+
+def test_random_model_replicas():
+    pool = ModelPool(RandomModel, [{}, {}])
+    try:
+        assert pool.name == "TestModel"
+        assert pool.parallelism == 2
+        responses = pool.generate_responses([f"prompt {i}" for i in range(10)], batch_size=3, final_answer=True)
+        assert len(responses) == 10
+        # The responses of the random model in this process, which has a handful of options
+        model = RandomModel()
+        options = {model.generate_response("") for _ in range(200)}
+        assert set(responses) <= options
+        assert len(pool.latest_stats) == 10
+        assert pool.latest_response == responses[-1]
+    finally:
+        pool.close()
+    assert not any(process.is_alive() for process in pool.processes)
+
+
+def test_order_and_settings():
+    """ The responses come back in the order of the prompts, generated with the prefix and token budget of the pool."""
+    pool = ModelPool(EchoModel, [{}, {}])
+    try:
+        prompts = [f"prompt {i}" for i in range(11)]
+        pool.cache_prefix("prefix")
+        pool.set_max_new_tokens(7)
+        responses = pool.generate_responses(prompts, batch_size=2)
+        assert [response.split("|")[:3] for response in responses] == [[prompt, "prefix", "7"] for prompt in prompts]
+        # The replicas run in processes of their own
+        assert os.getpid() not in {int(response.split("|")[3]) for response in responses}
+    finally:
+        pool.close()
+
+
+def test_failed_replica():
+    with pytest.raises(RuntimeError, match="failed to load"):
+        ModelPool(EchoModel, [{}], model_kwargs={"fail": True})
+
+
+def test_parse_replicas():
+    assert parse_replicas("cuda:0,cuda:1") == [{"device": "cuda:0"}, {"device": "cuda:1"}]
+    core = min(os.sched_getaffinity(0))
+    assert parse_replicas(f"cpu:{core}") == [{"device": "cpu", "cores": [core]}]
+    assert parse_replicas(f"cpu:{core}-{core}") == [{"device": "cpu", "cores": [core]}]
+    for devices in ("cpu:a", "cpu:3-1", "cpu:100000"):
+        with pytest.raises(ValueError):
+            parse_replicas(devices)
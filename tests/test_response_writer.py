@@ -0,0 +1,111 @@
+"""
+Tests of the buffered response writer: when it flushes, that the output is only replaced once complete, resuming,
+and the compressed copy.
+"""
+
+import gzip
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from response_writer import ResponseWriter
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_flushes_every_records(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    flushes = []
+    writer = ResponseWriter(path, flush_every=3, flush_interval=3600, on_flush=flushes.append)
+
+    for i in range(2):
+        writer.write({"i": i})
+    # Nothing is written before the buffer is full
+    assert not os.path.exists(writer.partial_path)
+    writer.write({"i": 2})
+    assert read_lines(writer.partial_path) == [{"i": 0}, {"i": 1}, {"i": 2}]
+    assert flushes == [3]
+    assert not os.path.exists(path)
+
+    writer.write({"i": 3})
+    writer.close()
+    assert read_lines(path) == [{"i": i} for i in range(4)]
+    assert not os.path.exists(writer.partial_path)
+    assert flushes == [3, 4]
+
+
+def test_flushes_after_interval(tmp_path):
+    writer = ResponseWriter(str(tmp_path / "responses.jsonl"), flush_every=100, flush_interval=0)
+    writer.write({"i": 0})
+    assert read_lines(writer.partial_path) == [{"i": 0}]
+    writer.close()
+
+
+def test_output_replaced_only_when_complete(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(json.dumps({"old": True}) + "\n")
+
+    writer = ResponseWriter(path, flush_every=1)
+    writer.write({"i": 0})
+    # The previous output stays intact while writing, and after a run that did not complete
+    assert read_lines(path) == [{"old": True}]
+    writer.close(complete=False)
+    assert read_lines(path) == [{"old": True}]
+    assert read_lines(writer.partial_path) == [{"i": 0}]
+
+    # Resuming continues the partial file, which replaces the output once complete
+    writer = ResponseWriter(path, flush_every=1, resume=True)
+    writer.write({"i": 1})
+    writer.close()
+    assert read_lines(path) == [{"i": 0}, {"i": 1}]
+    assert not os.path.exists(writer.partial_path)
+
+
+def test_partial_file_discarded_without_resume(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    writer = ResponseWriter(path, flush_every=1)
+    writer.write({"i": 0})
+    writer.close(complete=False)
+
+    writer = ResponseWriter(path, flush_every=1)
+    writer.write({"i": 1})
+    writer.close()
+    assert read_lines(path) == [{"i": 1}]
+
+
+def test_resume_from_complete_file(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    writer = ResponseWriter(path)
+    writer.write({"i": 0})
+    writer.close()
+
+    writer = ResponseWriter(path, resume=True)
+    writer.write({"i": 1})
+    writer.close()
+    assert read_lines(path) == [{"i": 0}, {"i": 1}]
+
+
+def test_compressed_copy(tmp_path):
+    contents = []
+    for directory in ("a", "b"):
+        path = str(tmp_path / directory / "responses.jsonl")
+        os.makedirs(os.path.dirname(path))
+        writer = ResponseWriter(path, compress=True)
+        for i in range(5):
+            writer.write({"i": i})
+        writer.close()
+
+        with open(path, "rb") as file, gzip.open(path + ".gz", "rb") as compressed:
+            assert compressed.read() == file.read()
+        assert not os.path.exists(path + ".gz.tmp")
+        with open(path + ".gz", "rb") as file:
+            contents.append(file.read())
+    # The same responses compress to the same bytes
+    assert contents[0] == contents[1]
@@ -0,0 +1,82 @@
+"""
+Tests of resuming an experiment from its partial response file and checkpoint.
+"""
+
+import json
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import Data
+from experiment import Experiment
+from models.model import Model
+from prompting_techniques.zero_shot import ZeroShot
+
+NUM_TEXTS = 30
+PARTIAL_PATH = "data/responses/Model_Zero-Shot.jsonl.partial"
+CHECKPOINT_PATH = "data/checkpoints/Model_Zero-Shot.json"
+
+
+class StoppingModel(Model):
+    """ Responds with an empty list, and is interrupted after a number of responses."""
+    def __init__(self, limit: int = None):
+        super().__init__("Model")
+        self.limit = limit
+        self.responses = 0
+
+    def generate_response(self, prompt):
+        if self.limit is not None and self.responses == self.limit:
+            raise KeyboardInterrupt("stopped")
+        self.responses += 1
+        return "[]"
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    """ The first texts of the gold standard, in a working directory of which the outputs go to its data/."""
+    with open(os.path.join(ROOT, "data/gold_standard_dataset.jsonl"), encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()][:NUM_TEXTS]
+    os.makedirs(tmp_path / "data" / "responses")
+    with open(tmp_path / "data" / "gold.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    monkeypatch.chdir(tmp_path)
+    return Data(data_path="data/gold.jsonl")
+
+
+def interrupted_run(data):
+    """ Run until interrupted after 20 responses (which are flushed when it stops), and leave half a line after them."""
+    with pytest.raises(KeyboardInterrupt):
+        Experiment(data, models=[StoppingModel(limit=20)], prompting_techniques=[ZeroShot], batch_size=1, flush_every=8).run()
+    with open(CHECKPOINT_PATH) as f:
+        assert json.load(f) == {"size": os.path.getsize(PARTIAL_PATH), "completed": 20}
+    with open(PARTIAL_PATH, "a") as f:
+        f.write('{"text": "half a li')
+
+
+def resumed_texts(data):
+    model = StoppingModel()
+    Experiment(data, models=[model], prompting_techniques=[ZeroShot], resume=True).run()
+    with open("data/responses/Model_Zero-Shot.jsonl", encoding="utf-8") as f:
+        texts = [json.loads(line)["text"] for line in f]
+    return texts, model.responses
+
+
+def test_resume_from_checkpoint(data):
+    interrupted_run(data)
+    texts, responses = resumed_texts(data)
+    assert sorted(texts) == sorted(text for text, labels in data)
+    assert responses == NUM_TEXTS - 20
+
+
+def test_resume_with_mismatched_checkpoint(data, capsys):
+    """ A checkpoint that does not belong to the partial file is not used to truncate it."""
+    interrupted_run(data)
+    with open(CHECKPOINT_PATH, "w") as f:
+        json.dump({"size": 10, "completed": 3}, f)
+    texts, responses = resumed_texts(data)
+    assert "does not match" in capsys.readouterr().out
+    assert sorted(texts) == sorted(text for text, labels in data)
+    assert responses == NUM_TEXTS - 20
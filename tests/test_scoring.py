@@ -0,0 +1,114 @@
+"""
+Regression test of the span scoring (Label.length/overlap, EvaluationFrameWork._comparison and score_runs) against the
+original set-based implementation, on the shipped response files.
+"""
+
+from glob import glob
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import Data, Label
+from evaluation import EvaluationFrameWork, load_gold_standard
+
+RESPONSE_PATHS = sorted(glob(os.path.join(ROOT, "data/responses/*.jsonl")))
+
+
+def old_indices(label: Label) -> set:
+    """ Label.indices as it was: the indices of the span as a set."""
+    if label.start == -1 and label.end == -1:
+        return set()
+    return set(range(label.start, label.end + 1))
+
+
+def old_comparison(p: Label, g: Label, include_indices: bool) -> float:
+    """ EvaluationFrameWork._comparison as it was, with the sizes of the index sets."""
+    delta = p.name.lower() == g.name.lower()
+    if include_indices:
+        intersection = len(old_indices(p).intersection(old_indices(g)))
+        h = len(old_indices(p)) + len(old_indices(g)) - intersection
+    else:
+        intersection = delta
+        h = 1
+    return (intersection / h) * delta
+
+
+def old_precision(P: list, G: list, include_indices: bool) -> float:
+    total_scores = []
+    for p_labels, g_labels in zip(P, G):
+        if not p_labels:
+            total_scores.append(0)
+            continue
+        total_scores.append(sum(max([old_comparison(p, g, include_indices) for g in g_labels], default=0) for p in p_labels) / len(p_labels))
+    return sum(total_scores) / len(total_scores)
+
+
+def old_recall(P: list, G: list, include_indices: bool) -> float:
+    total_scores = []
+    for p_labels, g_labels in zip(P, G):
+        G_minus = [g for g in g_labels if g.name.lower() != "nothing"]
+        if not G_minus:
+            total_scores.append(1.0)
+            continue
+        total_scores.append(sum(max([old_comparison(p, g, include_indices) for p in p_labels], default=0) for g in G_minus) / len(G_minus))
+    return sum(total_scores) / len(total_scores)
+
+
+def load_run(path: str) -> tuple:
+    """ The predicted and gold standard labels of the matched documents of a response file (as in evaluate_files)."""
+    gold_labels, gold_index = load_gold_standard(os.path.join(ROOT, "data/gold_standard_dataset.jsonl"))
+    P, G, report = EvaluationFrameWork.align(Data(data_path=path), gold_labels, gold_index)
+    for p in P:
+        for label in p:
+            if label.name == "Nothing":
+                label.name = "nothing"
+    return P, G
+
+
+@pytest.fixture(scope="module")
+def framework() -> EvaluationFrameWork:
+    # The scoring methods do not use the models or the gold standard of the framework
+    return EvaluationFrameWork.__new__(EvaluationFrameWork)
+
+
+def test_no_indices():
+    no_indices = Label(-1, -1, "ad hominem")
+    span = Label(3, 10, "ad hominem")
+    assert no_indices.length() == len(old_indices(no_indices)) == 0
+    assert no_indices.overlap(span) == span.overlap(no_indices) == 0
+    framework = EvaluationFrameWork.__new__(EvaluationFrameWork)
+    for include_indices in (True, False):
+        assert framework._comparison(no_indices, span, include_indices) == old_comparison(no_indices, span, include_indices)
+        assert framework._comparison(span, no_indices, include_indices) == old_comparison(span, no_indices, include_indices)
+
+
+def test_shipped_responses_exist():
+    assert RESPONSE_PATHS
+    # The files include labels without indices, so that case is covered below
+    assert any(label.start == -1 and label.end == -1 for path in RESPONSE_PATHS for text, labels in Data(data_path=path) for label in labels)
+
+
+@pytest.mark.parametrize("path", RESPONSE_PATHS, ids=os.path.basename)
+def test_comparison_matches_sets(framework, path):
+    P, G = load_run(path)
+    for p_labels, g_labels in zip(P, G):
+        for p in p_labels:
+            for g in g_labels:
+                assert p.length() == len(old_indices(p))
+                assert p.overlap(g) == len(old_indices(p) & old_indices(g))
+                for include_indices in (True, False):
+                    assert framework._comparison(p, g, include_indices) == old_comparison(p, g, include_indices)
+
+
+@pytest.mark.parametrize("path", RESPONSE_PATHS, ids=os.path.basename)
+def test_scores_match_sets(framework, path):
+    P, G = load_run(path)
+    scores = EvaluationFrameWork.score_runs({path: (P, G)})
+    for include_indices in (True, False):
+        precision, recall = old_precision(P, G, include_indices), old_recall(P, G, include_indices)
+        assert framework.calculate_precision(P, G, include_indices) == pytest.approx(precision, abs=1e-12)
+        assert framework.calculate_recall(P, G, include_indices) == pytest.approx(recall, abs=1e-12)
+        assert scores[(path, include_indices)] == pytest.approx((precision, recall), abs=1e-12)
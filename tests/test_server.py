@@ -0,0 +1,91 @@
+"""
+Tests of the client of OpenAI-compatible servers, against the stub server.
+"""
+
+import hashlib
+import os
+import random
+import sys
+import time
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from models.server import ServerError, ServerModel
+from models.stub_server import StubHandler, serve
+
+
+@pytest.fixture
+def stub():
+    """ Start a stub server on a free port, returns the URL of its completions endpoint."""
+    settings = (StubHandler.latency, StubHandler.failure_rate, StubHandler.timeout, StubHandler.requests)
+    StubHandler.requests = 0
+    server = serve(0, latency=0.01)
+    yield f"http://localhost:{server.server_address[1]}/v1/completions"
+    server.shutdown()
+    server.server_close()
+    StubHandler.latency, StubHandler.failure_rate, StubHandler.timeout, StubHandler.requests = settings
+
+
+def expected_response(prompt):
+    """ The response of the stub server to a prompt."""
+    return f"[['ad hominem', 0, {int(hashlib.sha1(prompt.encode('utf-8')).hexdigest(), 16) % 500}]]"
+
+
+def test_responses_in_order(stub):
+    model = ServerModel("Stub", "checkpoint", url=stub, max_connections=4)
+    try:
+        prompts = [f"prompt {i}" for i in range(20)] + ["prompt 1"] * 5
+        responses = model.generate_responses(prompts)
+        assert responses == [expected_response(prompt) for prompt in prompts]
+        assert model.latest_stats[0] == {"generated_tokens": 4, "stop_reason": "eos"}
+
+        report = model.get_performance_report()
+        # The identical prompts in flight at the same time are only sent once, over at most max_connections connections
+        assert report["requests"] + report["coalesced"] == len(prompts)
+        assert report["requests"] == StubHandler.requests
+        assert report["connections_opened"] <= 4
+
+        # The connections are kept open for the next call
+        model.generate_responses(["another prompt"])
+        assert model.get_performance_report()["connections_opened"] == report["connections_opened"]
+    finally:
+        model.close()
+
+
+def test_retries_failed_requests(stub):
+    StubHandler.failure_rate = 0.3
+    random.seed(0)
+    model = ServerModel("Stub", "checkpoint", url=stub, max_connections=4, max_retries=10, backoff=0.001)
+    try:
+        prompts = [f"prompt {i}" for i in range(20)]
+        assert model.generate_responses(prompts) == [expected_response(prompt) for prompt in prompts]
+        assert model.get_performance_report()["retries"] > 0
+    finally:
+        model.close()
+
+
+def test_gives_up_after_retries(stub):
+    StubHandler.failure_rate = 1.0
+    model = ServerModel("Stub", "checkpoint", url=stub, max_retries=2, backoff=0.001)
+    try:
+        with pytest.raises(ServerError) as error:
+            model.generate_response("prompt")
+        assert error.value.status == 503
+        assert StubHandler.requests == 3
+    finally:
+        model.close()
+
+
+def test_reconnects_after_idle_timeout(stub):
+    """ The server closes idle keep-alive connections, the next request then opens a new connection."""
+    StubHandler.timeout = 0.2
+    model = ServerModel("Stub", "checkpoint", url=stub, max_retries=0)
+    try:
+        assert model.generate_response("prompt") == expected_response("prompt")
+        time.sleep(0.5)
+        assert model.generate_response("after idle") == expected_response("after idle")
+        assert model.get_performance_report()["connections_opened"] == 2
+    finally:
+        model.close()
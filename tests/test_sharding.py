@@ -0,0 +1,96 @@
+"""
+Tests of the sharded experiment: the shards partition the texts, and merging them gives the same response files as an
+unsharded run.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import Data
+from experiment import Experiment, get_shard, merge_shards
+from models.model import Model
+from prompting_techniques.zero_shot import ZeroShot
+
+NUM_TEXTS = 20
+NUM_SHARDS = 3
+
+
+class HashModel(Model):
+    """ Responds with a tuple that depends on the prompt, such that every text has its own (reproducible) response."""
+    def __init__(self):
+        super().__init__("HashModel")
+
+    def generate_response(self, prompt):
+        end = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16) % 100
+        self.latest_response = f"[ad hominem, 0, {end}]"
+        return self.latest_response
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """ A working directory with the first texts of the gold standard (one of them twice), the outputs go to its data/."""
+    with open(os.path.join(ROOT, "data/gold_standard_dataset.jsonl"), encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()][:NUM_TEXTS - 1]
+    os.makedirs(tmp_path / "data" / "responses")
+    with open(tmp_path / "data" / "gold.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(lines + [lines[0]])
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def read_file(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_shards_partition_texts():
+    texts = [f"text {i}" for i in range(100)]
+    shards = [get_shard("model", "technique", text, NUM_SHARDS) for text in texts]
+    assert set(shards) == set(range(NUM_SHARDS))
+    # The same in every call (and thus in every process)
+    assert shards == [get_shard("model", "technique", text, NUM_SHARDS) for text in texts]
+
+
+def test_merge_is_lossless(workdir):
+    data = Data(data_path="data/gold.jsonl")
+    path = "data/responses/HashModel_Zero-Shot.jsonl"
+    Experiment(data=data, models=[HashModel()], prompting_techniques=[ZeroShot]).run()
+    unsharded = read_file(path)
+    os.remove(path)
+
+    for shard_index in range(NUM_SHARDS):
+        Experiment(data=data, models=[HashModel()], prompting_techniques=[ZeroShot], shard_index=shard_index, num_shards=NUM_SHARDS).run()
+    shard_texts = [[record["text"] for record in read_file(f"data/shards/HashModel_Zero-Shot/{i}-of-{NUM_SHARDS}.jsonl")]
+                   for i in range(NUM_SHARDS)]
+    # Every text is in exactly one shard (the duplicate text is in the same shard twice)
+    assert sorted(text for texts in shard_texts for text in texts) == sorted(text for text, labels in data)
+
+    report = merge_shards(data)
+    assert report["HashModel_Zero-Shot"]["complete"]
+    assert report["HashModel_Zero-Shot"]["responses"] == NUM_TEXTS
+    assert report["HashModel_Zero-Shot"]["missing"] == report["HashModel_Zero-Shot"]["extra"] == 0
+    assert read_file(path) == unsharded
+
+
+def test_merge_incomplete(workdir):
+    data = Data(data_path="data/gold.jsonl")
+    for shard_index in range(NUM_SHARDS - 1):
+        Experiment(data=data, models=[HashModel()], prompting_techniques=[ZeroShot], shard_index=shard_index, num_shards=NUM_SHARDS).run()
+
+    report = merge_shards(data)["HashModel_Zero-Shot"]
+    assert not report["complete"]
+    assert report["missing_shards"] == [NUM_SHARDS - 1]
+    assert report["missing"] > 0
+    assert not os.path.exists("data/responses/HashModel_Zero-Shot.jsonl")
+
+
+def test_merge_without_shards(workdir):
+    shutil.rmtree("data/shards", ignore_errors=True)
+    assert merge_shards(Data(data_path="data/gold.jsonl")) == {}
@@ -0,0 +1,86 @@
+"""
+Tests of the early stopping: when an answer is complete, and the incremental decoding of the stopping criteria.
+"""
+
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models.stopping import AnswerCompleteCriteria, answer_complete
+
+
+@pytest.mark.parametrize("text", [
+    # Empty lists and closed outer lists
+    "[]",
+    " [ ]",
+    "[['ad hominem', 1, 2]]",
+    # Tuples followed by an explanation or a blank line
+    "[ad hominem, 1, 2]\nThe speaker attacks the person.",
+    "[ad hominem, 1, 2], [straw man, 3, 4] because",
+    "[ad hominem, 1, 2]\n\n",
+    # Reasoning before the list
+    "Let's think. [ad hominem, 1, 2] Done",
+    # A verdict without a list
+    "The text does not contain any fallacy.",
+    "No fallacy\nBecause",
+])
+def test_complete(text):
+    assert answer_complete(text)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "[",
+    "[ad hominem, 1",
+    "[ad hominem, 1, 2]",
+    "[ad hominem, 1, 2], ",
+    "[ad hominem, 1, 2], [straw man, 3",
+    "[['ad hominem', 1, 2], ",
+    # A verdict that may still go on, and text that is not a verdict
+    "The text contains no fallacy",
+    "This is a fallacy.",
+])
+def test_not_complete(text):
+    assert not answer_complete(text)
+
+
+class CountingTokenizer:
+    """ Wraps a tokenizer, counting the number of tokens it decodes."""
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.decoded_tokens = 0
+
+    def decode(self, token_ids, **kwargs):
+        self.decoded_tokens += len(token_ids)
+        return self.tokenizer.decode(token_ids, **kwargs)
+
+
+def test_criteria_decodes_incrementally(tiny_checkpoint):
+    """ Each step only decodes the new tokens (and a few before them), and stopped sequences are not decoded again."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tiny_checkpoint)
+    counting = CountingTokenizer(tokenizer)
+
+    prompt = [tokenizer.eos_token_id] * 3
+    complete = tokenizer("[ad hominem, 12, 40]\nThe speaker attacks the person, not the argument, which is", add_special_tokens=False)["input_ids"]
+    unfinished = tokenizer("Let's think step by step about the text. [ad hominem, 12, 40], [straw man, 3, 9], [false", add_special_tokens=False)["input_ids"]
+    length = min(len(complete), len(unfinished))
+    criteria = AnswerCompleteCriteria(counting, prompt_length=len(prompt))
+
+    for step in range(1, length + 1):
+        input_ids = torch.tensor([prompt + complete[:step], prompt + unfinished[:step]])
+        is_done = criteria(input_ids, None)
+        for i in range(2):
+            if i not in criteria.stopped:
+                assert criteria.texts[i] == tokenizer.decode(input_ids[i, len(prompt):], skip_special_tokens=True)
+        assert bool(is_done[0]) == (0 in criteria.stopped)
+
+    assert criteria.stopped == {0}
+    # Decoding everything at each step would take quadratically many tokens
+    assert counting.decoded_tokens < 2 * (2 * 4 + 1) * length
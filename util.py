@@ -1,7 +1,6 @@
 from typing import List, Type
 from models.model import Model
-from models.falcon import Falcon
-from models.zephyr import Zephyr
+from models.registry import DEFAULT_REGISTRY
 from prompting_techniques.prompt import Prompt
 from prompting_techniques.zero_shot import ZeroShot
 from prompting_techniques.few_shot import FewShot
@@ -9,8 +8,9 @@ from prompting_techniques.automatic_cot import AutomaticCoT
 from prompting_techniques.generated_knowledge import GeneratedKnowledge
 
 
-def get_all_models() -> List[Type[Model]]:
-    return [Falcon, Zephyr]
+def get_all_models() -> List[Model]:
+    # Handles of the models, the weights are only loaded once a model generates (see ModelRegistry)
+    return [DEFAULT_REGISTRY.get("Falcon"), DEFAULT_REGISTRY.get("Zephyr")]
 
 
 def get_all_prompting_techniques() -> List[Type[Prompt]]: